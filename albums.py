@@ -0,0 +1,43 @@
+# albums.py - collects the posts of a media group so they can be processed as one unit
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class MediaGroupCollector:
+    """Gathers channel posts that share a media_group_id and passes each album to `callback` as one list.
+
+    An album is released `window` seconds after its latest post arrives, and never later than `max_wait`
+    seconds after its first one. Posts are handed over sorted by message id.
+    """
+
+    def __init__(self, callback, window=1.0, max_wait=5.0):
+        self.callback = callback; self.window = window; self.max_wait = max_wait
+        self._groups = {}; self._tasks = set()
+
+    def add(self, message):
+        key = (message.chat.id, message.media_group_id); now = time.monotonic()
+        group = self._groups.get(key)
+        if group is None: group = self._groups[key] = {"messages": [], "started": now, "timer": None}
+        else: group["timer"].cancel()
+        group["messages"].append(message)
+        delay = min(self.window, group["started"] + self.max_wait - now)
+        group["timer"] = asyncio.get_running_loop().call_later(max(delay, 0), self._release, key)
+
+    def pending(self):
+        return sum(len(group["messages"]) for group in self._groups.values())
+
+    async def flush(self):
+        for key, group in list(self._groups.items()): group["timer"].cancel(); self._release(key)
+        if self._tasks: await asyncio.wait(list(self._tasks))
+
+    def _release(self, key):
+        group = self._groups.pop(key, None)
+        if group is None: return
+        task = asyncio.create_task(self._process(sorted(group["messages"], key=lambda m: m.message_id)))
+        self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, messages):
+        try: await self.callback(messages)
+        except Exception: logger.exception(f"Failed to process album in {messages[0].chat.id}")
@@ -0,0 +1,66 @@
+# bench/fake_bot_api.py - local stand-in for the Telegram Bot API with latency and flood limits
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter
+
+import tornado.web
+
+from sender import TokenBucket
+
+class FakeBotAPI:
+    """Answers the Bot API methods the bot uses and records every call.
+
+    Each call waits `latency` seconds. Calls beyond `global_rate` per second, or beyond `chat_rate` per second for one
+    chat, are answered with 429 and a retry_after, as Telegram does. `flood_probability` injects extra 429s at random.
+    """
+
+    def __init__(self, latency=0.03, global_rate=30, chat_rate=20 / 60, chat_burst=3, flood_probability=0.0):
+        self.latency = latency; self.chat_rate = chat_rate; self.chat_burst = chat_burst; self.flood_probability = flood_probability
+        self.global_bucket = TokenBucket(global_rate, global_rate); self.chat_buckets = {}
+        self.calls = Counter(); self.floods = 0; self.captions = {}; self.edited_at = {}; self.copied = []; self._next_id = 10 ** 6
+
+    def reset(self):
+        self.calls.clear(); self.floods = 0; self.captions.clear(); self.edited_at.clear(); self.copied.clear()
+
+    def _throttle(self, chat_id):
+        if self.flood_probability and random.random() < self.flood_probability: return 1
+        now = time.monotonic()
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None: bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        wait = max(self.global_bucket.wait_time(now), bucket.wait_time(now) if chat_id is not None else 0)
+        if wait: return math.ceil(wait)
+        self.global_bucket.consume()
+        if chat_id is not None: bucket.consume()
+        return 0
+
+    def handle(self, method, params):
+        chat_id = params.get("chat_id"); chat_id = int(chat_id) if chat_id is not None else None
+        if method == "getMe": return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getChat": return {"id": chat_id, "type": "channel", "title": f"Channel {chat_id}"}
+        if method == "editMessageCaption":
+            message_id = int(params["message_id"]); self.captions[(chat_id, message_id)] = params.get("caption"); self.edited_at[(chat_id, message_id)] = time.perf_counter()
+            return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "channel"}, "caption": params.get("caption")}
+        if method == "copyMessages":
+            message_ids = json.loads(params["message_ids"]); self.copied.extend((int(params["from_chat_id"]), message_id) for message_id in message_ids)
+            self._next_id += len(message_ids); return [{"message_id": self._next_id - index} for index in range(len(message_ids))]
+        return {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id or 0, "type": "private"}}
+
+    def make_app(self):
+        api = self
+
+        class MethodHandler(tornado.web.RequestHandler):
+            async def post(self, method):
+                params = {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+                if not params and self.request.body: params = {key: value if isinstance(value, str) else json.dumps(value) for key, value in json.loads(self.request.body).items()}
+                api.calls[method] += 1
+                await asyncio.sleep(api.latency)
+                retry_after = api._throttle(params.get("chat_id")) if method != "getMe" else 0
+                if retry_after:
+                    api.floods += 1; self.set_status(429)
+                    return self.write({"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}", "parameters": {"retry_after": retry_after}})
+                self.write({"ok": True, "result": api.handle(method, params)})
+
+        return tornado.web.Application([(r"/bot[^/]+/(\w+)", MethodHandler)])
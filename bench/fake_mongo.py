@@ -0,0 +1,110 @@
+# bench/fake_mongo.py - in-memory stand-in for the pymongo collection calls the bot makes
+import copy
+import threading
+
+from pymongo import ReturnDocument
+
+_OPERATORS = {"$in": lambda value, arg: value in arg, "$lt": lambda value, arg: value is not None and value < arg, "$gt": lambda value, arg: value is not None and value > arg}
+
+def _matches(document, filter):
+    for key, condition in filter.items():
+        if key == "$or":
+            if not any(_matches(document, clause) for clause in condition): return False
+        elif isinstance(condition, dict) and condition and all(operator in _OPERATORS for operator in condition):
+            if not all(_OPERATORS[operator](document.get(key), arg) for operator, arg in condition.items()): return False
+        elif document.get(key) != condition: return False
+    return True
+
+def _project(document, projection):
+    if not projection: return copy.deepcopy(document)
+    return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, key == "_id" and projection.get("_id", 1))}
+
+def _apply(document, update):
+    for key, value in update.get("$set", {}).items():
+        target = document; *parents, leaf = key.split(".")
+        for parent in parents: target = target.setdefault(parent, {})
+        target[leaf] = copy.deepcopy(value)
+    for key in update.get("$unset", {}):
+        target = document; *parents, leaf = key.split(".")
+        for parent in parents: target = target.get(parent, {})
+        target.pop(leaf, None)
+    for key, value in update.get("$setOnInsert", {}).items() if document.get("__inserted__") else ():
+        document[key] = copy.deepcopy(value)
+    document.pop("__inserted__", None)
+
+class _Cursor(list):
+    def sort(self, key, direction=1):
+        for field, order in reversed(key if isinstance(key, list) else [(key, direction)]): super().sort(key=lambda document: document.get(field), reverse=order < 0)
+        return self
+
+    def limit(self, count): return _Cursor(self[:count]) if count else self
+
+class _BulkWriteResult:
+    def __init__(self, upserted_ids): self.upserted_ids = upserted_ids
+
+class _Client:
+    def close(self): pass
+
+class _Database:
+    client = _Client()
+
+class FakeCollection:
+    """Supports equality, $in/$lt/$gt and $or filters, $set/$unset/$setOnInsert updates and upserts; enough for the bot's queries."""
+    database = _Database()
+
+    def __init__(self, documents=()):
+        self._documents = {document["_id"]: copy.deepcopy(document) for document in documents}; self._lock = threading.Lock()
+        self.calls = 0
+
+    def create_index(self, *args, **kwargs): return "index"
+    def index_information(self): return {"_id_": {"key": [("_id", 1)]}}
+
+    def find_one(self, filter, projection=None):
+        with self._lock:
+            self.calls += 1
+            for document in self._documents.values():
+                if _matches(document, filter): return _project(document, projection)
+        return None
+
+    def find(self, filter=None, projection=None):
+        with self._lock:
+            self.calls += 1
+            return _Cursor(_project(document, projection) for document in self._documents.values() if _matches(document, filter or {}))
+
+    def _update(self, filter, update, upsert):
+        # Returns the document before and after the update; `before` is None for an upsert and both are None for a miss.
+        with self._lock:
+            self.calls += 1
+            document = next((document for document in self._documents.values() if _matches(document, filter)), None)
+            if document is None:
+                if not upsert: return None, None
+                document = {**filter, "__inserted__": True}; self._documents[document["_id"]] = document; before = None
+            else: before = copy.deepcopy(document)
+            _apply(document, update)
+            return before, copy.deepcopy(document)
+
+    def find_one_and_update(self, filter, update, upsert=False, return_document=ReturnDocument.BEFORE):
+        before, after = self._update(filter, update, upsert)
+        return after if return_document == ReturnDocument.AFTER else before
+
+    def update_one(self, filter, update, upsert=False):
+        self.find_one_and_update(filter, update, upsert=upsert)
+
+    def update_many(self, filter, update):
+        with self._lock:
+            self.calls += 1
+            for document in self._documents.values():
+                if _matches(document, filter): _apply(document, update)
+
+    def bulk_write(self, operations, ordered=True):
+        upserted_ids = {}
+        for index, operation in enumerate(operations):
+            before, after = self._update(operation._filter, operation._doc, operation._upsert)
+            if after is not None and before is None: upserted_ids[index] = after["_id"]
+        return _BulkWriteResult(upserted_ids)
+
+    def delete_one(self, filter):
+        with self._lock:
+            self.calls += 1
+            for key, document in list(self._documents.items()):
+                if _matches(document, filter): del self._documents[key]; return
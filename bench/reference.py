@@ -0,0 +1,26 @@
+# bench/reference.py - the original inline cleaning and caption code, kept as the golden reference
+import html
+import os
+import re
+
+def legacy_clean_filename(original_file_name, settings):
+    cleaned_file_name = original_file_name
+    if settings.get("link_remover_on"):
+        cleaned_file_name = re.sub(r'https?://\S+|@\w+|\[.*?\]|\(.*?\)', '', cleaned_file_name)
+        cleaned_file_name = re.sub(r'[_.-]{2,}', '_', cleaned_file_name).strip('_. -')
+    banned_words = settings.get("banned_words", [])
+    if banned_words:
+        pattern = r'\b(' + '|'.join(re.escape(word) for word in banned_words) + r')\b'
+        cleaned_file_name = re.sub(pattern, '', cleaned_file_name, flags=re.IGNORECASE).strip()
+        cleaned_file_name = re.sub(r'\s{2,}', ' ', cleaned_file_name).strip()
+        cleaned_file_name = re.sub(r'[_.-]{2,}', '_', cleaned_file_name).strip('_. -')
+    return cleaned_file_name
+
+def legacy_caption(settings, file_name, file_size, file_caption):
+    cleaned_file_name = legacy_clean_filename(file_name, settings)
+    file_title, file_ext = os.path.splitext(cleaned_file_name)
+    new_caption_template = settings.get("caption_text") or ""
+    if not new_caption_template: return cleaned_file_name
+    file_size_mb = f"{file_size / (1024*1024):.2f} MB" if file_size else "N/A"
+    safe_full_name = html.escape(str(cleaned_file_name)); safe_title = html.escape(file_title); safe_file_caption = html.escape(file_caption)
+    return new_caption_template.replace("{file_name}", safe_full_name).replace("{file_title}", safe_title).replace("{file_size}", file_size_mb).replace("{file_caption}", safe_file_caption)
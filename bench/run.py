@@ -0,0 +1,227 @@
+# bench/run.py - offline load test and microbenchmarks for auto_caption_handler
+"""Feeds synthetic channel posts through the real Application handlers against local stand-ins.
+
+    python -m bench.run                      # every scenario plus the microbenchmarks
+    python -m bench.run --scenario albums    # one scenario
+    python -m bench.run --micro-only         # only the cleaning / templating microbenchmarks
+
+The Bot API stand-in enforces the same limits the bot is configured with, scaled up by default so a run takes
+seconds; pass --chat-rate 0.333 --global-rate 30 for Telegram's real limits. Captions the stand-in receives are
+checked against bench/reference.py, the original inline implementation. A final check seeds the journal as if the
+bot had stopped mid-burst, including entries that can't be processed, and verifies the startup drain resumes the rest.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import string
+import sys
+import time
+import timeit
+
+LOG_CHANNEL_ID = -1009999999999
+BOT_TOKEN = "123456:bench"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", help="scenario to run (repeatable); default: all")
+    parser.add_argument("--latency", type=float, default=0.03, help="simulated Bot API latency in seconds")
+    parser.add_argument("--global-rate", type=float, default=300, help="global calls per second allowed by the fake API")
+    parser.add_argument("--chat-rate", type=float, default=10, help="calls per second per chat allowed by the fake API")
+    parser.add_argument("--flood", type=float, default=0.0, help="probability of an extra random 429 per call")
+    parser.add_argument("--port", type=int, default=8881)
+    parser.add_argument("--micro-only", action="store_true")
+    parser.add_argument("--seed", type=int, default=7)
+    return parser.parse_args()
+
+# --- Synthetic Data ---
+TAGS = ["[HDHub]", "(Dual Audio)", "@MoviesHub", "https://t.me/joinchat/xyz", "[x265]", "(2023)", "@Filmy_World", "http://example.com/a?b=c"]
+def random_word(rng, length=None): return "".join(rng.choice(string.ascii_letters) for _ in range(length or rng.randint(3, 9)))
+
+def random_filename(rng, blacklist=(), link_heavy=False):
+    parts = [random_word(rng) for _ in range(rng.randint(2, 5))]
+    if blacklist: parts += rng.sample(list(blacklist), min(3, len(blacklist)))
+    parts += rng.sample(TAGS, rng.randint(3, 6) if link_heavy else rng.randint(0, 2))
+    rng.shuffle(parts)
+    return rng.choice([".", " ", "_", "-"]).join(parts) + rng.choice([".mkv", ".mp4", ".pdf", ".zip"])
+
+TEMPLATES = ["<b>{file_title}</b>\n\nSize: {file_size}", "{file_name}\n{file_caption}", "📁 {file_name} | {file_size}", ""]
+
+def make_channel(rng, channel_id, blacklist_size=5, link_remover_on=True, album_first_only=False):
+    return {"_id": channel_id, "admin_user_id": 1, "caption_text": rng.choice(TEMPLATES), "link_remover_on": link_remover_on, "album_first_only": album_first_only,
+            "banned_words": [random_word(rng) for _ in range(blacklist_size)], "chat_meta": {"title": f"Channel {channel_id}", "accessible": True, "refreshed_at": time.time()}}
+
+def make_post(rng, channel, message_id, media_group_id=None, link_heavy=False):
+    name = random_filename(rng, channel["banned_words"], link_heavy)
+    post = {"message_id": message_id, "date": int(time.time()), "chat": {"id": channel["_id"], "type": "channel", "title": "bench"},
+            "document": {"file_id": f"f{message_id}", "file_unique_id": f"u{message_id}", "file_name": name, "file_size": rng.randint(0, 4 * 1024 ** 3), "mime_type": "video/x-matroska"}}
+    if rng.random() < 0.5: post["caption"] = random_word(rng, 12)
+    if media_group_id: post["media_group_id"] = media_group_id
+    return post
+
+def build_scenarios(rng):
+    """Returns scenario name -> (channel documents, post dicts)."""
+    scenarios = {}; next_channel = [-1001000000000]
+    def channels(count, **kwargs):
+        result = []
+        for _ in range(count): next_channel[0] -= 1; result.append(make_channel(rng, next_channel[0], **kwargs))
+        return result
+    def singles(channel_list, per_channel, link_heavy=False):
+        return [make_post(rng, channel, 100 + index, link_heavy=link_heavy) for index in range(per_channel) for channel in channel_list]
+    def albums(channel_list, per_channel, size):
+        return [make_post(rng, channel, 100 + album * size + item, media_group_id=f"{channel['_id']}-{album}") for channel in channel_list for album in range(per_channel) for item in range(size)]
+    chans = channels(5); scenarios["singles"] = (chans, singles(chans, 40))
+    chans = channels(5); scenarios["albums"] = (chans, albums(chans, 8, 10))
+    chans = channels(5, album_first_only=True); scenarios["albums_first_only"] = (chans, albums(chans, 8, 10))
+    chans = channels(2, blacklist_size=1000); scenarios["long_blacklist"] = (chans, singles(chans, 50))
+    chans = channels(5, blacklist_size=0); scenarios["link_heavy"] = (chans, singles(chans, 40, link_heavy=True))
+    chans = channels(200); scenarios["many_channels"] = (chans, singles(chans, 2))
+    return scenarios
+
+# --- Load Test ---
+def expected_caption(channel, post):
+    from bench.reference import legacy_caption
+    document = post["document"]
+    return legacy_caption(channel, document["file_name"], document["file_size"], post.get("caption") or "")
+
+def percentile(values, fraction):
+    if not values: return float("nan")
+    ordered = sorted(values); return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+async def drain(main, application, fake, settle=0.3):
+    idle_since = None
+    while True:
+        busy = (not application.update_queue.empty() or main.album_collector.pending() or main.sender.queued() or main.sender.stats()["in_flight"]
+                or any(main.mirror.stats()[key] for key in ("queued", "buffered", "pending_batches")))
+        if busy: idle_since = None
+        elif idle_since is None: idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > settle: return
+        await asyncio.sleep(0.02)
+
+async def run_scenario(name, channels, posts, main, application, fake):
+    from telegram import Update
+    fake.reset(); by_id = {channel["_id"]: channel for channel in channels}
+    enqueued = {}; started = time.perf_counter()
+    for update_id, post in enumerate(posts):
+        enqueued[(post["chat"]["id"], post["message_id"])] = time.perf_counter()
+        await application.update_queue.put(Update.de_json({"update_id": update_id, "channel_post": post}, application.bot))
+    await drain(main, application, fake)
+    expected, mismatches = {}, 0
+    for post in posts:
+        channel = by_id[post["chat"]["id"]]; key = (channel["_id"], post["message_id"])
+        if channel.get("album_first_only") and post.get("media_group_id") and post["message_id"] != min(p["message_id"] for p in posts if p.get("media_group_id") == post["media_group_id"]): continue
+        caption = expected_caption(channel, post)
+        if caption != (post.get("caption") or ""): expected[key] = caption
+    for key, caption in expected.items():
+        if fake.captions.get(key) != caption: mismatches += 1
+    latencies = [fake.edited_at[key] - enqueued[key] for key in expected if key in fake.edited_at]
+    finished = max(fake.edited_at.values(), default=started)
+    api_calls = sum(count for method, count in fake.calls.items() if method != "getChat")
+    return {"scenario": name, "posts": len(posts), "edits": len(fake.edited_at), "posts_per_s": len(posts) / max(finished - started, 1e-9),
+            "p50_ms": percentile(latencies, 0.5) * 1000, "p99_ms": percentile(latencies, 0.99) * 1000, "api_calls_per_post": api_calls / len(posts),
+            "floods": fake.floods, "mirrored": len(fake.copied), "golden_mismatches": mismatches + (len(expected) - len(latencies))}
+
+async def check_recovery(main, application, fake):
+    """Returns a list of problems found after draining a journal seeded with good, uncaptionable and malformed entries."""
+    import database
+    import journal
+    fake.reset(); channels = [-1002000000001, -1002000000002, -1002000000003]
+    for channel_id in channels: database.channels_collection.update_one({"_id": channel_id}, {"$set": {"caption_text": "<b>{file_title}</b>", "link_remover_on": True}}, upsert=True)
+    def seed(channel_id, file_name):
+        post = {"file_name": file_name, "file_size": 1, "caption": "", "duration": None, "width": None, "height": None, "mime_type": None, "date": None}
+        fields = {"chat_id": channel_id, "message_id": 1, "album_index": 0, "post": post, "captioned": False, "mirrored": False}
+        journal.journal_collection.update_one({"_id": journal.journal_id(channel_id, 1)}, {"$set": fields}, upsert=True)
+    seed(channels[0], None)                                   # stored before file names had a fallback
+    seed(channels[1], "good.mkv")
+    seed(channels[2], "broken.mkv")                           # its missing mirrored flag makes claim() raise
+    journal.journal_collection.update_one({"_id": journal.journal_id(channels[2], 1)}, {"$unset": {"mirrored": ""}})
+    await main.drain_journal(application.bot, lambda chat_id: True)
+    await drain(main, application, fake); await main.journal.flush()
+    stored = {document["chat_id"]: document for document in journal.journal_collection.find({"chat_id": {"$in": channels}})}
+    problems = []
+    if fake.captions.get((channels[1], 1)) != "<b>good</b>": problems.append(f"valid entry not captioned: {fake.captions.get((channels[1], 1))!r}")
+    if sorted(fake.copied) != sorted([(channels[0], 1), (channels[1], 1)]): problems.append(f"unexpected mirror copies: {fake.copied}")
+    for channel_id in channels[:2]:
+        if not (stored[channel_id]["captioned"] and stored[channel_id]["mirrored"]): problems.append(f"entry of {channel_id} left pending")
+    if main.journal.in_flight(): problems.append(f"{main.journal.in_flight()} entries still claimed")
+    return problems
+
+async def load_test(args, scenarios):
+    import database
+    import journal
+    from bench.fake_bot_api import FakeBotAPI
+    from bench.fake_mongo import FakeCollection
+    import main
+    fake = FakeBotAPI(latency=args.latency, global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=int(os.environ["SEND_CHAT_BURST"]), flood_probability=args.flood)
+    server = fake.make_app().listen(args.port, address="127.0.0.1")
+    database.channels_collection = FakeCollection([channel for channels, _ in scenarios.values() for channel in channels]); journal.journal_collection = FakeCollection()
+    application = main.build_application(BOT_TOKEN, base_url=f"http://127.0.0.1:{args.port}/bot")
+    results = []
+    async with application:
+        await main.on_startup(application); await application.start()
+        try:
+            for name, (channels, posts) in scenarios.items(): results.append(await run_scenario(name, channels, posts, main, application, fake))
+            recovery_problems = await check_recovery(main, application, fake)
+        finally:
+            await application.stop(); await main.on_shutdown(application); server.stop()
+    main.close_db()
+    return results, recovery_problems
+
+# --- Microbenchmarks ---
+def micro_benchmarks(rng):
+    from bench.reference import legacy_clean_filename
+    from captions import get_template, render_caption
+    from cleaner import clean_filename
+    rows = []
+    for size in (0, 10, 100, 1000):
+        for link_remover_on in (False, True):
+            settings = {"link_remover_on": link_remover_on, "banned_words": [random_word(rng) for _ in range(size)]}
+            names = [random_filename(rng, settings["banned_words"], link_heavy=link_remover_on) for _ in range(200)]
+            mismatches = sum(clean_filename(name, settings) != legacy_clean_filename(name, settings) for name in names)
+            new = min(timeit.repeat(lambda: [clean_filename(name, settings) for name in names], number=5, repeat=3)) / (5 * len(names))
+            old = min(timeit.repeat(lambda: [legacy_clean_filename(name, settings) for name in names], number=5, repeat=3)) / (5 * len(names))
+            rows.append((f"clean words={size} links={link_remover_on}", old, new, mismatches))
+    from bench.reference import legacy_caption
+    for template in TEMPLATES[:3] + ["{file_name}"]:
+        settings = {"caption_text": template}
+        posts = [{"file_name": random_filename(rng), "file_size": rng.randint(0, 10 ** 9), "caption": random_word(rng, 20)} for _ in range(200)]
+        compiled = get_template(template)
+        mismatches = sum(render_caption(compiled, post, post["file_name"]) != legacy_caption(settings, post["file_name"], post["file_size"], post["caption"]) for post in posts)
+        new = min(timeit.repeat(lambda: [render_caption(get_template(template), post, post["file_name"]) for post in posts], number=20, repeat=3)) / (20 * len(posts))
+        old = min(timeit.repeat(lambda: [legacy_caption(settings, post["file_name"], post["file_size"], post["caption"]) for post in posts], number=20, repeat=3)) / (20 * len(posts))
+        rows.append((f"caption {template[:24]!r}", old, new, mismatches))
+    return rows
+
+# Fixed expectations, so a change to bench/reference.py itself cannot hide a regression.
+GOLDEN_CLEAN = [
+    ("[HDHub] Movie.Name__2023 @chan (Dual).mkv", {"link_remover_on": True}, "Movie.Name_2023  .mkv"),
+    ("The.Movie.x265.HDRip.mkv", {"banned_words": ["x265", "hdrip"]}, "The.Movie_mkv"),
+    ("Show  S01E01 -- Rip.mp4", {"banned_words": ["rip"]}, "Show S01E01 _ .mp4"),
+]
+
+def main_cli():
+    args = parse_args(); rng = random.Random(args.seed)
+    os.environ.update({"MONGO_DB_NAME": "bench", "LOG_CHANNEL_ID": str(LOG_CHANNEL_ID), "BOT_TOKEN": BOT_TOKEN, "ALBUM_WINDOW": "0.05", "MIRROR_LINGER": "0.2",
+                       "SEND_GLOBAL_RATE": str(args.global_rate), "SEND_CHAT_RATE_PER_MINUTE": str(args.chat_rate * 60), "SEND_CHAT_BURST": os.environ.get("SEND_CHAT_BURST", "3")})
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from cleaner import clean_filename
+    failures = [(name, settings, expected, clean_filename(name, settings)) for name, settings, expected in GOLDEN_CLEAN if clean_filename(name, settings) != expected]
+    for failure in failures: print("GOLDEN MISMATCH", failure)
+    print(f"{'microbenchmark':<40} {'legacy µs':>10} {'current µs':>11} {'speedup':>8} {'mismatches':>11}")
+    for label, old, new, mismatches in micro_benchmarks(rng):
+        print(f"{label:<40} {old * 1e6:>10.1f} {new * 1e6:>11.1f} {old / new:>7.1f}x {mismatches:>11}"); failures += [label] * bool(mismatches)
+    if not args.micro_only:
+        scenarios = build_scenarios(rng)
+        if args.scenario: scenarios = {name: scenarios[name] for name in args.scenario}
+        for noisy in ("httpx", "tornado.access", "telegram", "sender", "mirror"): logging.getLogger(noisy).setLevel(logging.ERROR)
+        results, recovery_problems = asyncio.run(load_test(args, scenarios))
+        print(f"\n{'scenario':<18} {'posts':>6} {'edits':>6} {'posts/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'calls/post':>10} {'429s':>5} {'mirrored':>8} {'mismatch':>8}")
+        for r in results:
+            print(f"{r['scenario']:<18} {r['posts']:>6} {r['edits']:>6} {r['posts_per_s']:>8.1f} {r['p50_ms']:>8.0f} {r['p99_ms']:>8.0f} {r['api_calls_per_post']:>10.2f} {r['floods']:>5} {r['mirrored']:>8} {r['golden_mismatches']:>8}")
+            failures += [r["scenario"]] * bool(r["golden_mismatches"])
+        print("\nrecovery check: " + ("; ".join(recovery_problems) or "ok")); failures += recovery_problems
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main_cli()
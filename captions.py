@@ -0,0 +1,70 @@
+# captions.py - caption templates, compiled once and rendered per post
+import html
+import os
+import re
+from functools import lru_cache
+
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')
+
+class TemplateError(ValueError):
+    pass
+
+# --- Post Description ---
+# Used when Telegram sends no file name, which photos never have and videos, audio and documents may lack.
+FALLBACK_NAMES = (("document", "File"), ("video", "Video"), ("audio", "Audio"), ("photo", "Photo"))
+
+def describe_post(message):
+    """Returns the plain fields caption placeholders read from a channel post, or None if it carries no file."""
+    kind = next((kind for kind, _ in FALLBACK_NAMES if getattr(message, kind)), None)
+    if kind is None: return None
+    file_obj = message.photo[-1] if kind == "photo" else getattr(message, kind)
+    duration = getattr(file_obj, 'duration', None)
+    if hasattr(duration, 'total_seconds'): duration = int(duration.total_seconds())
+    return {
+        "file_name": getattr(file_obj, 'file_name', None) or dict(FALLBACK_NAMES)[kind], "file_size": file_obj.file_size, "caption": message.caption or "",
+        "duration": duration, "width": getattr(file_obj, 'width', None), "height": getattr(file_obj, 'height', None),
+        "mime_type": getattr(file_obj, 'mime_type', None), "date": message.date,
+    }
+
+# --- Placeholders ---
+def _format_size(post, file_name): return f"{post['file_size'] / (1024*1024):.2f} MB" if post["file_size"] else "N/A"
+def _format_duration(post, file_name):
+    if not post.get("duration"): return "N/A"
+    minutes, seconds = divmod(post["duration"], 60); hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+def _format_resolution(post, file_name): return f"{post['width']}x{post['height']}" if post.get("width") and post.get("height") else "N/A"
+
+PLACEHOLDERS = {
+    "file_name": lambda post, file_name: html.escape(str(file_name)),
+    "file_title": lambda post, file_name: html.escape(os.path.splitext(file_name)[0]),
+    "file_ext": lambda post, file_name: html.escape(os.path.splitext(file_name)[1].lstrip('.')) or "N/A",
+    "file_size": _format_size,
+    "file_caption": lambda post, file_name: html.escape(post["caption"]),
+    "duration": _format_duration,
+    "resolution": _format_resolution,
+    "mime_type": lambda post, file_name: html.escape(post.get("mime_type") or "N/A"),
+    "date": lambda post, file_name: post["date"].strftime("%Y-%m-%d") if post.get("date") else "N/A",
+}
+
+# --- Templates ---
+def compile_template(text, strict=False):
+    """Splits a caption template into literal strings and placeholder functions.
+
+    Unknown placeholders raise TemplateError when `strict`, otherwise they are kept as literal text.
+    """
+    segments, position, unknown = [], 0, []
+    for match in PLACEHOLDER_PATTERN.finditer(text):
+        render = PLACEHOLDERS.get(match.group(1))
+        if render is None: unknown.append(match.group(0)); continue
+        if match.start() > position: segments.append(text[position:match.start()])
+        segments.append(render); position = match.end()
+    if strict and unknown: raise TemplateError(f"Unknown placeholder(s): {', '.join(dict.fromkeys(unknown))}")
+    if position < len(text): segments.append(text[position:])
+    return tuple(segments)
+
+@lru_cache(maxsize=4096)
+def get_template(text):
+    return compile_template(text)
+
+def render_caption(template, post, file_name):
+    return "".join(segment if segment.__class__ is str else segment(post, file_name) for segment in template)
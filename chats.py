@@ -0,0 +1,28 @@
+# chats.py - cached chat metadata (title and access status) for the settings menus
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden
+
+from database import update_channel_settings
+
+logger = logging.getLogger(__name__)
+
+def make_chat_meta(title, accessible=True):
+    return {"title": title, "accessible": accessible, "refreshed_at": time.time()}
+
+def is_stale(meta, ttl):
+    return not meta or time.time() - meta.get("refreshed_at", 0) > ttl
+
+async def fetch_chat_meta(bot, channel_id, previous=None):
+    try: chat = await bot.get_chat(channel_id); meta = make_chat_meta(chat.title)
+    except (Forbidden, BadRequest): meta = make_chat_meta((previous or {}).get("title"), accessible=False)
+    await update_channel_settings(channel_id, {"$set": {"chat_meta": meta}}); return meta
+
+async def refresh_chat_meta(bot, channels, concurrency=8):
+    """Re-fetches metadata for `channels` (a dict of channel id to its cached meta) with at most `concurrency` calls in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+    async def refresh(channel_id, previous):
+        async with semaphore: return channel_id, await fetch_chat_meta(bot, channel_id, previous)
+    return dict(await asyncio.gather(*(refresh(channel_id, previous) for channel_id, previous in channels.items())))
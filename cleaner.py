@@ -0,0 +1,58 @@
+# cleaner.py - filename cleaning engine used by auto_caption_handler
+import re
+from functools import lru_cache
+
+LINK_PATTERN = re.compile(r'https?://\S+|@\w+|\[.*?\]|\(.*?\)')
+SEPARATOR_RUNS = re.compile(r'[_.-]{2,}')
+# Whitespace runs and separator runs use disjoint characters, so both collapses can share one pass.
+SPACING_RUNS = re.compile(r'(\s{2,})|[_.-]{2,}')
+WORD_ONLY = re.compile(r'\w+')
+# Below this many words a plain alternation is already fast; above it the trie pattern wins.
+TRIE_MIN_WORDS = 64
+
+def _collapse_run(match): return ' ' if match.group(1) else '_'
+
+def _trie_pattern(node):
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches: return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node: return (body if len(branches) > 1 else '(?:' + body + ')') + '?'
+    return body
+
+def compile_banned_words(words):
+    """Compiles a blacklist into one case-insensitive whole-word matcher."""
+    if len(words) >= TRIE_MIN_WORDS and all(WORD_ONLY.fullmatch(word) for word in words):
+        # Pure word-character entries can only ever match a whole \w run, so at most one of them fits at any
+        # position and the trie's longest-first order picks the same word the ordered alternation would.
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word: node = node.setdefault(char, {})
+            node[''] = {}
+        return re.compile(r'\b(?:' + _trie_pattern(trie) + r')\b', re.IGNORECASE)
+    return re.compile(r'\b(' + '|'.join(re.escape(word) for word in words) + r')\b', re.IGNORECASE)
+
+class FilenameCleaner:
+    """Link and banned-word rules for one channel, compiled once."""
+    __slots__ = ("link_remover_on", "banned_pattern")
+
+    def __init__(self, link_remover_on, banned_words):
+        self.link_remover_on = link_remover_on
+        self.banned_pattern = compile_banned_words(banned_words) if banned_words else None
+
+    def clean(self, name):
+        if self.link_remover_on:
+            name = SEPARATOR_RUNS.sub('_', LINK_PATTERN.sub('', name)).strip('_. -')
+        if self.banned_pattern is not None:
+            name = SPACING_RUNS.sub(_collapse_run, self.banned_pattern.sub('', name)).strip().strip('_. -')
+        return name
+
+@lru_cache(maxsize=4096)
+def get_cleaner(link_remover_on, banned_words):
+    return FilenameCleaner(link_remover_on, banned_words)
+
+def clean_filename(name, settings):
+    """Applies a channel's link remover and words remover settings to a filename."""
+    link_remover_on = bool(settings.get("link_remover_on")); banned_words = settings.get("banned_words")
+    if not link_remover_on and not banned_words: return name
+    return get_cleaner(link_remover_on, tuple(banned_words or ())).clean(name)
@@ -0,0 +1,141 @@
+# database.py - async repository over pymongo for the bot's channel settings
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread, Lock
+
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import PyMongoError
+
+from metrics import mongo_seconds
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+MONGO_URI = os.environ.get("MONGO_URI")
+MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 20))
+MONGO_TIMEOUT_MS = int(os.environ.get("MONGO_TIMEOUT_MS", 5000))
+# pymongo is blocking, so every call runs on this pool. More threads than pooled connections would only queue inside the driver.
+MONGO_THREADS = int(os.environ.get("MONGO_THREADS", MONGO_MAX_POOL_SIZE))
+SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", 5000))
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", 300))
+
+# --- Connection ---
+def get_db_collection():
+    if not MONGO_DB_NAME: raise ValueError("MONGO_DB_NAME environment variable is not set.")
+    try:
+        client = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS, connectTimeoutMS=MONGO_TIMEOUT_MS, socketTimeoutMS=MONGO_TIMEOUT_MS)
+        db = client[MONGO_DB_NAME]; return db.channels
+    except Exception as e: logger.error(f"Could not connect to MongoDB: {e}"); raise
+channels_collection = get_db_collection()
+bot_state_collection = channels_collection.database.bot_state
+journal_collection = channels_collection.database.post_journal
+_executor = ThreadPoolExecutor(max_workers=MONGO_THREADS, thread_name_prefix="mongo")
+
+async def run(fn, *args, **kwargs):
+    """Runs a blocking pymongo call on the database pool without blocking the event loop."""
+    with mongo_seconds.time(operation=fn.__name__):
+        return await asyncio.get_running_loop().run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+async def init_db():
+    await run(channels_collection.create_index, "admin_user_id")
+
+def close_db():
+    _executor.shutdown(wait=False)
+    channels_collection.database.client.close()
+
+# --- Settings Cache ---
+class SettingsCache:
+    """Bounded LRU cache of channel documents with a TTL. A cached `None` marks an unregistered channel."""
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize; self.ttl = ttl
+        self._entries = OrderedDict(); self._lock = Lock(); self._writes = 0
+        self.hits = 0; self.misses = 0
+
+    def get(self, channel_id):
+        with self._lock:
+            entry = self._entries.get(channel_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1; return self.MISSING
+            self._entries.move_to_end(channel_id); self.hits += 1
+            return entry[1]
+
+    def stamp(self):
+        with self._lock: return self._writes
+
+    def fill(self, channel_id, settings, stamp):
+        # A read that raced with a write must not overwrite the newer value the write stored.
+        with self._lock:
+            if stamp == self._writes: self._store(channel_id, settings)
+
+    def put(self, channel_id, settings):
+        with self._lock: self._writes += 1; self._store(channel_id, settings)
+
+    def invalidate(self, channel_id):
+        with self._lock: self._writes += 1; self._entries.pop(channel_id, None)
+
+    def _store(self, channel_id, settings):
+        self._entries[channel_id] = (time.monotonic() + self.ttl, settings); self._entries.move_to_end(channel_id)
+        while len(self._entries) > self.maxsize: self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock: size = len(self._entries)
+        total = self.hits + self.misses
+        return {"size": size, "hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / total if total else 0.0}
+
+settings_cache = SettingsCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL)
+_pending_reads = {}
+# Called with the channel id after every local settings write, e.g. to tell other processes to drop their cached copy.
+settings_listeners = []
+
+def _notify(channel_id):
+    for listener in settings_listeners: listener(channel_id)
+
+# --- Repository ---
+async def get_channel_settings(channel_id):
+    settings = settings_cache.get(channel_id)
+    if settings is not SettingsCache.MISSING: return settings
+    # Concurrent misses for the same channel (e.g. an album) share a single find_one.
+    if channel_id in _pending_reads: return await asyncio.shield(_pending_reads[channel_id])
+    stamp = settings_cache.stamp()
+    future = _pending_reads[channel_id] = asyncio.ensure_future(run(channels_collection.find_one, {"_id": channel_id}))
+    try: settings = await asyncio.shield(future)
+    finally: _pending_reads.pop(channel_id, None)
+    settings_cache.fill(channel_id, settings, stamp); return settings
+
+def find_all(filter, projection=None): return list(channels_collection.find(filter, projection))
+
+async def get_user_channels(user_id):
+    """Returns the user's channel documents with only their id and cached chat metadata."""
+    return await run(find_all, {"admin_user_id": user_id}, {"_id": 1, "chat_meta": 1})
+
+async def update_channel_settings(channel_id, update, upsert=False):
+    settings = await run(channels_collection.find_one_and_update, {"_id": channel_id}, update, upsert=upsert, return_document=ReturnDocument.AFTER)
+    settings_cache.put(channel_id, settings); _notify(channel_id); return settings
+
+async def delete_channel_settings(channel_id, **extra_filter):
+    await run(channels_collection.delete_one, {"_id": channel_id, **extra_filter}); settings_cache.invalidate(channel_id); _notify(channel_id)
+
+# --- Change Stream ---
+def watch_settings_changes():
+    # Keeps the cache consistent with writes made by other bot processes. Needs a replica set.
+    try:
+        with channels_collection.watch(full_document="updateLookup") as stream:
+            for change in stream:
+                channel_id = change["documentKey"]["_id"]
+                if change["operationType"] in ("insert", "update", "replace"): settings_cache.put(channel_id, change.get("fullDocument"))
+                elif change["operationType"] == "delete": settings_cache.put(channel_id, None)
+                else: settings_cache.invalidate(channel_id)
+    except PyMongoError as e: logger.warning(f"Settings change stream stopped, relying on cache TTL: {e}")
+
+def start_settings_watcher():
+    t = Thread(target=watch_settings_changes, name="settings-watcher")
+    t.daemon = True
+    t.start()
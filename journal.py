@@ -0,0 +1,116 @@
+# journal.py - durable record of channel posts, for dedup, crash recovery and re-applying captions
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from database import journal_collection, run
+
+logger = logging.getLogger(__name__)
+
+FLAGS = ("captioned", "mirrored")
+
+def journal_id(chat_id, message_id): return f"{chat_id}:{message_id}"
+
+# --- Queries (run on the database pool) ---
+def upsert_entries(operations): return journal_collection.bulk_write(operations, ordered=False)
+def find_entries(ids): return list(journal_collection.find({"_id": {"$in": ids}}))
+def find_pending(after, limit): return list(journal_collection.find({"_id": {"$gt": after}, "$or": [{flag: False} for flag in FLAGS]}).sort("_id", ASCENDING).limit(limit))
+def find_recent(chat_id, before, limit): return list(journal_collection.find({"chat_id": chat_id, "message_id": {"$lt": before}}).sort("message_id", DESCENDING).limit(limit))
+def set_flag(ids, flag): return journal_collection.update_many({"_id": {"$in": ids}}, {"$set": {flag: True}})
+
+def set_ttl(ttl_seconds):
+    # create_index refuses to change the options of an existing index, so a new TTL is applied with collMod.
+    ttl_index = journal_collection.index_information().get("created_at_1")
+    if ttl_index is None: journal_collection.create_index("created_at", expireAfterSeconds=ttl_seconds)
+    elif ttl_index.get("expireAfterSeconds") != ttl_seconds:
+        journal_collection.database.command("collMod", journal_collection.name, index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": ttl_seconds})
+        logger.info(f"Changed journal TTL from {ttl_index.get('expireAfterSeconds')}s to {ttl_seconds}s")
+
+async def init_journal(ttl_seconds):
+    await run(set_ttl, int(ttl_seconds))
+    await run(journal_collection.create_index, [("chat_id", ASCENDING), ("message_id", DESCENDING)])
+
+class PostJournal:
+    """Keeps one entry per channel post, keyed by (chat_id, message_id), with a `captioned` and a `mirrored` flag.
+
+    `record` inserts entries only once and hands back just the work still outstanding, so redelivered updates are
+    skipped. Flags are buffered and written with one update_many per flag `flush_delay` seconds after a change.
+    """
+
+    def __init__(self, flush_delay=0.5):
+        self.flush_delay = flush_delay; self._marks = {flag: set() for flag in FLAGS}; self._in_flight = {}; self._flush_task = None
+        self.skipped = 0
+
+    # --- Recording ---
+    async def record(self, chat_id, posts):
+        """Journals `posts` (dicts with at least a message_id) and returns the entries this process should work on."""
+        created_at = datetime.now(timezone.utc); entries = []; operations = []
+        for post in posts:
+            entry_id = journal_id(chat_id, post["message_id"]); fields = {"chat_id": chat_id, **post, **dict.fromkeys(FLAGS, False), "created_at": created_at}
+            operations.append(UpdateOne({"_id": entry_id}, {"$setOnInsert": fields}, upsert=True)); entries.append({"_id": entry_id, **fields})
+        result = await run(upsert_entries, operations)
+        # Freshly inserted entries are known already; only redelivered posts need their stored flags read back.
+        existing = [entry["_id"] for index, entry in enumerate(entries) if index not in result.upserted_ids]
+        if existing:
+            stored = {entry["_id"]: entry for entry in await run(find_entries, existing)}
+            entries = [stored.get(entry["_id"], entry) for entry in entries]
+        return self.claim(entries)
+
+    def claim(self, entries):
+        """Returns the entries that have outstanding flags and are not already being worked on in this process."""
+        claimed = []
+        for entry in entries:
+            for flag in FLAGS: entry[flag] = entry[flag] or entry["_id"] in self._marks[flag]
+            outstanding = {flag for flag in FLAGS if not entry[flag]}
+            if outstanding and entry["_id"] not in self._in_flight: self._in_flight[entry["_id"]] = outstanding; claimed.append(entry)
+            else: self.skipped += 1
+        return claimed
+
+    def mark(self, flag, chat_id, message_ids):
+        for message_id in message_ids: self._marks[flag].add(journal_id(chat_id, message_id))
+        self.release(flag, chat_id, message_ids)
+        if self._flush_task is None or self._flush_task.done(): self._flush_task = asyncio.create_task(self._flush_later())
+
+    def release(self, flag, chat_id, message_ids):
+        """Stops tracking `flag` of the entries. Without a `mark` the flag stays unset for the next startup drain."""
+        for message_id in message_ids:
+            entry_id = journal_id(chat_id, message_id); outstanding = self._in_flight.get(entry_id)
+            if outstanding is None: continue
+            outstanding.discard(flag)
+            if not outstanding: del self._in_flight[entry_id]
+
+    def abandon(self, chat_id, message_ids):
+        """Stops tracking the entries altogether after their processing failed, so a redelivery or the next drain retries them."""
+        for message_id in message_ids: self._in_flight.pop(journal_id(chat_id, message_id), None)
+
+    def in_flight(self): return len(self._in_flight)
+
+    # --- Flushing ---
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay); await self.flush()
+
+    async def flush(self):
+        for flag, ids in self._marks.items():
+            if not ids: continue
+            # Flags leave the buffer only once written, so `claim` never trusts a stored flag that is about to change.
+            batch = list(ids)
+            try: await run(set_flag, batch, flag)
+            except Exception as e: logger.error(f"Failed to flag {len(batch)} journal entries {flag}: {e}")
+            else: ids.difference_update(batch)
+
+    # --- Reading ---
+    async def pending(self, batch_size=500):
+        """Yields every stored entry with an outstanding flag, `batch_size` entries per query."""
+        after = ""
+        while entries := await run(find_pending, after, batch_size):
+            yield entries
+            after = entries[-1]["_id"]
+
+    async def recent(self, chat_id, limit, batch_size=100):
+        """Yields the channel's last `limit` journaled posts newest first, `batch_size` entries per query."""
+        before = float("inf")
+        while limit > 0 and (entries := await run(find_recent, chat_id, before, min(batch_size, limit))):
+            yield entries
+            limit -= len(entries); before = entries[-1]["message_id"]
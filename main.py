@@ -1,19 +1,17 @@
 # main.py (Final Definitive Version with Corrected Image Links)
 import logging
 import os
-import re
 import html
 import json
 import traceback
 import asyncio
 import random
-from pymongo import MongoClient
-from pymongo.errors import ConfigurationError
+import time
+import signal
+import secrets
+from functools import partial
 
-from flask import Flask
-from threading import Thread
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -23,21 +21,23 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ConversationHandler,
+    Updater,
 )
-from telegram.error import Forbidden, BadRequest
+from telegram.error import BadRequest, NetworkError
 from telegram.constants import ParseMode
 
-# --- Web Server for Hosting ---
-app = Flask('')
-@app.route('/')
-def home():
-    return "I'm alive!"
-def run_flask():
-  app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.daemon = True
-    t.start()
+from albums import MediaGroupCollector
+from captions import PLACEHOLDERS, TemplateError, compile_template, describe_post, get_template, render_caption
+from chats import fetch_chat_meta, is_stale, make_chat_meta, refresh_chat_meta
+from cleaner import clean_filename
+from journal import PostJournal, init_journal
+from metrics import GaugeFunction, InstrumentedRequest, channel_posts, record_error, stage_seconds, update_seconds
+from mirror import MirrorPipeline
+from persistence import MongoPersistence
+from server import application_receiver, make_web_app, shard_metrics
+from shards import ShardRouter, consume, shard_of_chat
+from sender import PRIORITY_CAPTION, PRIORITY_REAPPLY, SendScheduler
+from database import settings_cache, settings_listeners, init_db, close_db, get_channel_settings, get_user_channels, update_channel_settings, delete_channel_settings, start_settings_watcher
 
 # --- Basic Setup ---
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -45,10 +45,41 @@ logger = logging.getLogger(__name__)
 
 # --- Environment Variables ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
-MONGO_URI = os.environ.get("MONGO_URI")
-MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME")
 LOG_CHANNEL_ID = int(os.environ.get("LOG_CHANNEL_ID"))
 DEVELOPER_CHAT_ID = os.environ.get("DEVELOPER_CHAT_ID")
+PORT = int(os.environ.get("PORT", 8000))
+# Webhook mode is used when WEBHOOK_URL (the public base URL of this server) is set, long polling otherwise.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Webhook posts must carry the secret token; without WEBHOOK_SECRET a random one is registered at startup.
+# WEBHOOK_INSECURE accepts unauthenticated posts and is meant only for local testing against a stand-in Bot API.
+WEBHOOK_INSECURE = os.environ.get("WEBHOOK_INSECURE", "").lower() in ("1", "true", "yes")
+if WEBHOOK_URL and not WEBHOOK_SECRET and not WEBHOOK_INSECURE: WEBHOOK_SECRET = secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+BOT_API_POOL_SIZE = int(os.environ.get("BOT_API_POOL_SIZE", 256))
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "").lower() in ("1", "true", "yes")
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE_PER_MINUTE = float(os.environ.get("SEND_CHAT_RATE_PER_MINUTE", 20))
+SEND_CHAT_BURST = int(os.environ.get("SEND_CHAT_BURST", 3))
+SEND_MAX_IN_FLIGHT = int(os.environ.get("SEND_MAX_IN_FLIGHT", 16))
+MIRROR_QUEUE_SIZE = int(os.environ.get("MIRROR_QUEUE_SIZE", 10000))
+MIRROR_LINGER = float(os.environ.get("MIRROR_LINGER", 2))
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", 1))
+ALBUM_MAX_WAIT = float(os.environ.get("ALBUM_MAX_WAIT", 5))
+CHAT_META_TTL = float(os.environ.get("CHAT_META_TTL", 6 * 3600))
+CHAT_META_CONCURRENCY = int(os.environ.get("CHAT_META_CONCURRENCY", 8))
+# With more than one worker, a receiver process routes updates to SHARD_WORKERS processes partitioned by chat id.
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", 1))
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 5))
+# Shard worker N serves /metrics (and /debug/profile) on 127.0.0.1:SHARD_METRICS_PORT+N; the receiver's /metrics merges them.
+SHARD_METRICS_PORT = int(os.environ.get("SHARD_METRICS_PORT", PORT + 1))
+SETTINGS_CHANGE_STREAM = os.environ.get("SETTINGS_CHANGE_STREAM", "").lower() in ("1", "true", "yes")
+# Journal entries (and with them dedup and "re-apply caption") cover posts from the last JOURNAL_TTL_DAYS days.
+JOURNAL_TTL_DAYS = float(os.environ.get("JOURNAL_TTL_DAYS", 7))
+JOURNAL_DRAIN_BATCH = int(os.environ.get("JOURNAL_DRAIN_BATCH", 500))
+REAPPLY_BATCH_SIZE = int(os.environ.get("REAPPLY_BATCH_SIZE", 100))
+REAPPLY_CHOICES = (10, 50, 200)
 
 # --- THE FIX: Using your new direct image URLs ---
 PHOTO_LINKS = [
@@ -65,19 +96,40 @@ PHOTO_LINKS = [
 # --- Conversation states ---
 SELECT_CHANNEL, MAIN_MENU, CAPTION_MENU, WORDS_REMOVER_MENU, AWAITING_CAPTION, AWAITING_WORDS, CONFIRM_REMOVE = range(7)
 
-# --- Database & Helper Functions ---
-def get_db_collection():
-    if not MONGO_DB_NAME: raise ValueError("MONGO_DB_NAME environment variable is not set.")
-    try: client = MongoClient(MONGO_URI); db = client[MONGO_DB_NAME]; return db.channels
-    except Exception as e: logger.error(f"Could not connect to MongoDB: {e}"); raise
-channels_collection = get_db_collection(); channels_collection.create_index("admin_user_id")
-def get_channel_settings(channel_id): return channels_collection.find_one({"_id": channel_id})
-def get_user_channels(user_id):
-    channels_cursor = channels_collection.find({"admin_user_id": user_id}); return [c["_id"] for c in channels_cursor]
+# --- Outbound Scheduler ---
+# Each shard worker owns its channels outright but shares the global budget and the log channel with the others.
+sender = SendScheduler(global_rate=SEND_GLOBAL_RATE / SHARD_WORKERS, chat_rate=SEND_CHAT_RATE_PER_MINUTE / 60, chat_burst=SEND_CHAT_BURST, max_in_flight=SEND_MAX_IN_FLIGHT,
+                       chat_rates={LOG_CHANNEL_ID: SEND_CHAT_RATE_PER_MINUTE / 60 / SHARD_WORKERS})
+journal = PostJournal()
+mirror = MirrorPipeline(sender, LOG_CHANNEL_ID, maxsize=MIRROR_QUEUE_SIZE, linger=MIRROR_LINGER, on_settled=partial(journal.mark, "mirrored"))
+
+GaugeFunction("autocaption_send_queue_depth", "Outbound calls waiting in the send scheduler, by priority.", lambda: sender.stats()["queued"], ["priority"])
+GaugeFunction("autocaption_send_in_flight", "Outbound calls currently running.", lambda: sender.stats()["in_flight"])
+GaugeFunction("autocaption_send_wait_seconds_max", "Longest queue wait of a completed outbound call.", lambda: sender.wait_max)
+GaugeFunction("autocaption_mirror_backlog", "Posts queued, buffered or batched for the log channel and not yet settled.", lambda: mirror.stats()["outstanding"])
+GaugeFunction("autocaption_mirror_pending_batches", "Batches waiting to be copied to the log channel, including ones in retry.", lambda: mirror.stats()["pending_batches"])
+GaugeFunction("autocaption_settings_cache", "Settings cache counters.", settings_cache.stats, ["field"])
+GaugeFunction("autocaption_journal_in_flight", "Journaled posts being captioned or mirrored by this process.", journal.in_flight)
+GaugeFunction("autocaption_journal_skipped_posts", "Posts skipped because the journal had them done or in progress.", lambda: journal.skipped)
+
+# --- Lifecycle ---
+async def on_startup(application: Application, shard=None) -> None:
+    """Starts the background pipelines. `shard` is `(index, count)` in a shard worker, which drains only its own channels."""
+    await init_db(); await init_journal(JOURNAL_TTL_DAYS * 86400)
+    sender.start(); mirror.start(application.bot)
+    if SETTINGS_CHANGE_STREAM: start_settings_watcher()
+    owns_chat = (lambda chat_id: shard_of_chat(chat_id, shard[1]) == shard[0]) if shard else (lambda chat_id: True)
+    application.bot_data["journal_drain"] = asyncio.create_task(drain_journal(application.bot, owns_chat), name="journal-drain")
+
+async def on_shutdown(application: Application) -> None:
+    drain = application.bot_data.pop("journal_drain", None)
+    if drain: drain.cancel()
+    await album_collector.flush(); await mirror.stop(); await sender.stop(); await journal.flush()
 
 # --- Error Handler ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Exception while handling an update:", exc_info=context.error)
+    record_error(context.error)
     if isinstance(context.error, BadRequest) and "message is not modified" in str(context.error).lower(): return
     if DEVELOPER_CHAT_ID:
         try:
@@ -119,19 +171,28 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else: await update.message.reply_text(text=help_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML', disable_web_page_preview=True)
 
 # --- Conversation Flow ---
+async def revalidate_user_channels(bot, user_id, channels):
+    for channel_id, meta in (await refresh_chat_meta(bot, channels, CHAT_META_CONCURRENCY)).items():
+        if not meta["accessible"]:
+            logger.warning(f"Bot can't access channel {channel_id}. Removing from DB.")
+            await delete_channel_settings(channel_id, admin_user_id=user_id)
+
 async def settings_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     if query: await query.answer()
     user_id = update.effective_user.id
-    user_channels_ids = get_user_channels(user_id)
+    channels = {c["_id"]: c.get("chat_meta") for c in await get_user_channels(user_id)}
+    # Channels seen for the first time have nothing to show yet; everything else renders from cache.
+    unknown = {channel_id: meta for channel_id, meta in channels.items() if not meta}
+    if unknown: channels.update(await refresh_chat_meta(context.bot, unknown, CHAT_META_CONCURRENCY))
+    stale = {channel_id: meta for channel_id, meta in channels.items() if channel_id not in unknown and is_stale(meta, CHAT_META_TTL)}
+    if stale: context.application.create_task(revalidate_user_channels(context.bot, user_id, stale))
     keyboard = []
-    for channel_id in user_channels_ids:
-        try:
-            chat = await context.bot.get_chat(channel_id)
-            keyboard.append([InlineKeyboardButton(f"{chat.title}", callback_data=f"channel_{channel_id}")])
-        except (Forbidden, BadRequest):
+    for channel_id, meta in channels.items():
+        if meta["accessible"]: keyboard.append([InlineKeyboardButton(f"{meta['title']}", callback_data=f"channel_{channel_id}")])
+        else:
             logger.warning(f"Bot can't access channel {channel_id}. Removing from DB.")
-            channels_collection.delete_one({"_id": channel_id, "admin_user_id": user_id})
+            await delete_channel_settings(channel_id, admin_user_id=user_id)
     if not keyboard:
         text = "I'm not an admin in any of your channels yet. Add me to a channel first."
         if query: await query.message.edit_caption(caption=text, reply_markup=None)
@@ -153,47 +214,83 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if 'channel_' in query.data:
         context.user_data['current_channel_id'] = int(query.data.split('_')[1])
     channel_id = context.user_data['current_channel_id']
-    settings = get_channel_settings(channel_id) or {}; link_remover_status = "ON ✔️" if settings.get('link_remover_on', False) else "OFF ❌"
-    keyboard = [[InlineKeyboardButton("📝 Set Caption", callback_data="caption_menu")], [InlineKeyboardButton("🚫 Set Words Remover", callback_data="words_remover_menu")], [InlineKeyboardButton(f"✂️ Link Remover: {link_remover_status}", callback_data="toggle_link_remover")], [InlineKeyboardButton("🗑️ Remove Channel", callback_data="confirm_remove")], [InlineKeyboardButton("⬅️ Back", callback_data="settings_menu")]]
-    await query.message.edit_text(f"Managing settings for: <b>{(await context.bot.get_chat(channel_id)).title}</b>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    settings = await get_channel_settings(channel_id) or {}; link_remover_status = "ON ✔️" if settings.get('link_remover_on', False) else "OFF ❌"
+    album_mode = "First Only" if settings.get('album_first_only', False) else "All Files"
+    keyboard = [[InlineKeyboardButton("📝 Set Caption", callback_data="caption_menu")], [InlineKeyboardButton("🚫 Set Words Remover", callback_data="words_remover_menu")], [InlineKeyboardButton(f"✂️ Link Remover: {link_remover_status}", callback_data="toggle_link_remover")], [InlineKeyboardButton(f"🖼️ Album Captions: {album_mode}", callback_data="toggle_album_first_only")], [InlineKeyboardButton("🗑️ Remove Channel", callback_data="confirm_remove")], [InlineKeyboardButton("⬅️ Back", callback_data="settings_menu")]]
+    chat_meta = settings.get('chat_meta') or await fetch_chat_meta(context.bot, channel_id)
+    await query.message.edit_text(f"Managing settings for: <b>{html.escape(chat_meta['title'] or str(channel_id))}</b>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
     return MAIN_MENU
 
+async def edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text, keyboard, **kwargs) -> None:
+    """Shows a menu in place of the settings message, also when called after the user replied with a text message."""
+    if update.callback_query: await update.callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), **kwargs)
+    else: await context.bot.edit_message_text(text, chat_id=update.effective_chat.id, message_id=context.user_data['menu_message_id'], reply_markup=InlineKeyboardMarkup(keyboard), **kwargs)
+
 async def caption_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query; await query.answer()
-    settings = get_channel_settings(context.user_data['current_channel_id']) or {}
+    query = update.callback_query
+    if query: await query.answer()
+    settings = await get_channel_settings(context.user_data['current_channel_id']) or {}
     caption_text = settings.get("caption_text", "Not Set")
     text = f"<b>Caption Settings</b>\n\nCurrent Caption:\n<pre>{html.escape(caption_text)}</pre>"
-    keyboard = [[InlineKeyboardButton("✏️ Set Caption", callback_data="set_caption_prompt")], [InlineKeyboardButton("🗑️ Del Caption", callback_data="delete_caption")], [InlineKeyboardButton("⬅️ Back", callback_data="main_menu_back")]]
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML', disable_web_page_preview=True)
+    keyboard = [[InlineKeyboardButton("✏️ Set Caption", callback_data="set_caption_prompt")], [InlineKeyboardButton("🗑️ Del Caption", callback_data="delete_caption")], [InlineKeyboardButton("🔁 Re-apply to Recent Posts", callback_data="reapply_prompt")], [InlineKeyboardButton("⬅️ Back", callback_data="main_menu_back")]]
+    await edit_menu(update, context, text, keyboard, parse_mode='HTML', disable_web_page_preview=True)
+    return CAPTION_MENU
+
+async def reapply_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query; await query.answer()
+    text = f"Re-apply the current caption to how many of the latest posts? Only posts from the last {JOURNAL_TTL_DAYS:g} days are covered."
+    keyboard = [[InlineKeyboardButton(f"Last {count}", callback_data=f"reapply_{count}") for count in REAPPLY_CHOICES], [InlineKeyboardButton("⬅️ Back", callback_data="caption_menu")]]
+    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return CAPTION_MENU
+
+async def run_reapply(bot, user_id, channel_id, limit):
+    edited = await reapply_caption(bot, channel_id, limit)
+    await bot.send_message(chat_id=user_id, text=f"✅ Caption re-applied to {edited} recent post(s).")
+
+async def start_reapply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query; await query.answer()
+    limit = int(query.data.split('_')[1]); channel_id = context.user_data['current_channel_id']
+    job = {"user_id": update.effective_user.id, "channel_id": channel_id, "limit": limit}
+    # The edits belong on the worker that owns the channel, where its posts are captioned and its journal claims live.
+    shard = context.application.bot_data.get("shard")
+    if shard and shard_of_chat(channel_id, shard[1]) != shard[0]: shard[2].put((shard[0], {"chat_id": channel_id, "reapply": job}))
+    else: context.application.create_task(run_reapply(context.bot, **job))
+    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="caption_menu")]]
+    await query.message.edit_text(f"Re-applying the caption to the last {limit} posts. I'll message you when it's done.", reply_markup=InlineKeyboardMarkup(keyboard))
     return CAPTION_MENU
 
 async def set_caption_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; await query.answer()
-    text = "Send me the new caption text..."
+    text = "Send me the new caption text...\n\nAvailable placeholders: " + " ".join(f"{{{name}}}" for name in PLACEHOLDERS)
     keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="caption_menu")]]
     await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     return AWAITING_CAPTION
 
 async def save_caption(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     channel_id = context.user_data['current_channel_id']; new_caption_text = update.message.text
-    channels_collection.update_one({"_id": channel_id}, {"$set": {"caption_text": new_caption_text}}, upsert=True)
+    try: compile_template(new_caption_text, strict=True)
+    except TemplateError as e:
+        await update.message.reply_text(f"{e}\n\nAvailable placeholders: " + " ".join(f"{{{name}}}" for name in PLACEHOLDERS))
+        return AWAITING_CAPTION
+    await update_channel_settings(channel_id, {"$set": {"caption_text": new_caption_text}}, upsert=True)
     await update.message.delete()
     await caption_menu(update, context)
     return CAPTION_MENU
 
 async def delete_caption(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; await query.answer("Caption deleted!")
-    channels_collection.update_one({"_id": context.user_data['current_channel_id']}, {"$unset": {"caption_text": ""}})
+    await update_channel_settings(context.user_data['current_channel_id'], {"$unset": {"caption_text": ""}})
     await caption_menu(update, context)
     return CAPTION_MENU
 
 async def words_remover_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query; await query.answer()
-    settings = get_channel_settings(context.user_data['current_channel_id']) or {}
+    query = update.callback_query
+    if query: await query.answer()
+    settings = await get_channel_settings(context.user_data['current_channel_id']) or {}
     banned_words = settings.get("banned_words", []); banned_words_text = ", ".join(banned_words) if banned_words else "No words blacklisted."
     text = f"<b>Words Remover Settings</b>\n\nThese words will be removed from filenames.\n\nCurrent Blacklist:\n<pre>{html.escape(banned_words_text)}</pre>"
     keyboard = [[InlineKeyboardButton("✏️ Set Blacklist", callback_data="set_words_remover_prompt")], [InlineKeyboardButton("🗑️ Del Blacklist", callback_data="delete_words_remover")], [InlineKeyboardButton("⬅️ Back", callback_data="main_menu_back")]]
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    await edit_menu(update, context, text, keyboard, parse_mode='HTML')
     return WORDS_REMOVER_MENU
 
 async def set_words_remover_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -206,22 +303,30 @@ async def set_words_remover_prompt(update: Update, context: ContextTypes.DEFAULT
 async def save_words_remover(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     channel_id = context.user_data['current_channel_id']
     words_to_ban = [word.strip() for word in update.message.text.split(',') if word.strip()]
-    channels_collection.update_one({"_id": channel_id}, {"$set": {"banned_words": words_to_ban}}, upsert=True)
+    await update_channel_settings(channel_id, {"$set": {"banned_words": words_to_ban}}, upsert=True)
     await update.message.delete()
     await words_remover_menu(update, context)
     return WORDS_REMOVER_MENU
 
 async def delete_words_remover(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; await query.answer("Blacklist cleared!")
-    channels_collection.update_one({"_id": context.user_data['current_channel_id']}, {"$unset": {"banned_words": ""}})
+    await update_channel_settings(context.user_data['current_channel_id'], {"$unset": {"banned_words": ""}})
     await words_remover_menu(update, context)
     return WORDS_REMOVER_MENU
     
 async def toggle_link_remover(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; await query.answer()
     channel_id = context.user_data.get('current_channel_id')
-    current_state = (get_channel_settings(channel_id) or {}).get('link_remover_on', False)
-    channels_collection.update_one({"_id": channel_id}, {"$set": {"link_remover_on": not current_state}}, upsert=True)
+    current_state = (await get_channel_settings(channel_id) or {}).get('link_remover_on', False)
+    await update_channel_settings(channel_id, {"$set": {"link_remover_on": not current_state}}, upsert=True)
+    await main_menu(update, context)
+    return MAIN_MENU
+
+async def toggle_album_first_only(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query; await query.answer()
+    channel_id = context.user_data.get('current_channel_id')
+    current_state = (await get_channel_settings(channel_id) or {}).get('album_first_only', False)
+    await update_channel_settings(channel_id, {"$set": {"album_first_only": not current_state}}, upsert=True)
     await main_menu(update, context)
     return MAIN_MENU
 
@@ -233,7 +338,7 @@ async def confirm_remove_channel(update: Update, context: ContextTypes.DEFAULT_T
 
 async def perform_remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; await query.answer()
-    channels_collection.delete_one({"_id": context.user_data['current_channel_id']})
+    await delete_channel_settings(context.user_data['current_channel_id'])
     await query.message.edit_text("Channel removed successfully.")
     return ConversationHandler.END
 
@@ -243,41 +348,119 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.effective_user.send_message("Operation canceled.")
     return ConversationHandler.END
 
+def build_caption(settings, post):
+    if not post: return None
+    with stage_seconds.time(stage="clean"): cleaned_file_name = clean_filename(post["file_name"], settings)
+    new_caption_template = settings.get("caption_text") or ""
+    if not new_caption_template: return cleaned_file_name
+    with stage_seconds.time(stage="render"): return render_caption(get_template(new_caption_template), post, cleaned_file_name)
+
+def observe_caption_edit(future, submitted, started):
+    if future.cancelled() or future.exception(): return
+    now = time.perf_counter()
+    stage_seconds.observe(now - submitted, stage="caption_edit"); update_seconds.observe(now - started)
+
+def settle_caption_edit(channel_id, message_id, future):
+    # Edits given up after timeouts or network errors stay pending in the journal, so the next startup drain retries them.
+    error = None if future.cancelled() else future.exception()
+    if future.cancelled() or isinstance(error, NetworkError) and not isinstance(error, BadRequest): journal.release("captioned", channel_id, [message_id])
+    else: journal.mark("captioned", channel_id, [message_id])
+
+def journal_post(message, album_index=0):
+    return {"message_id": message.message_id, "album_index": album_index, "post": describe_post(message)}
+
+def entry_caption(settings, channel_id, entry):
+    """Returns the caption for a journaled post, or None if it gets none or can't be captioned."""
+    if settings.get("album_first_only") and entry["album_index"]: return None
+    # A post that can't be captioned is left as is, so it doesn't hold up the rest of its album or the mirror.
+    try: return build_caption(settings, entry["post"])
+    except Exception as e: logger.error(f"Failed to build caption for message {entry['message_id']} in {channel_id}: {e}"); return None
+
+async def process_entries(bot, settings, channel_id, entries, started=None):
+    """Captions and mirrors the journal entries still missing either step."""
+    captioned = []
+    for entry in entries:
+        if entry["captioned"]: continue
+        new_caption = entry_caption(settings, channel_id, entry)
+        if new_caption is None or new_caption == entry["post"]["caption"]: captioned.append(entry["message_id"]); continue
+        future = sender.submit(channel_id, partial(bot.edit_message_caption, chat_id=channel_id, message_id=entry["message_id"], caption=new_caption, parse_mode='HTML'), PRIORITY_CAPTION, f"caption edit in {channel_id}")
+        future.add_done_callback(partial(settle_caption_edit, channel_id, entry["message_id"]))
+        if started: future.add_done_callback(partial(observe_caption_edit, submitted=time.perf_counter(), started=started))
+    if captioned:
+        journal.mark("captioned", channel_id, captioned)
+        # Posts that need no edit are settled now and still count towards end-to-end latency.
+        if started:
+            elapsed = time.perf_counter() - started
+            for _ in captioned: update_seconds.observe(elapsed)
+    to_mirror = [entry["message_id"] for entry in entries if not entry["mirrored"]]
+    if to_mirror:
+        with stage_seconds.time(stage="mirror_enqueue"): await mirror.enqueue(channel_id, to_mirror)
+
+async def process_posts(bot, settings, messages, started):
+    channel_id = messages[0].chat.id
+    channel_posts.inc(len(messages), channel=channel_id)
+    with stage_seconds.time(stage="journal"): entries = await journal.record(channel_id, [journal_post(message, index if message.media_group_id else 0) for index, message in enumerate(messages)])
+    try: await process_entries(bot, settings, channel_id, entries, started)
+    except BaseException:
+        journal.abandon(channel_id, [entry["message_id"] for entry in entries]); raise
+
+async def drain_journal(bot, owns_chat):
+    """Finishes journaled posts that a previous run received but did not caption or mirror before it stopped."""
+    resumed = failed = 0
+    try:
+        async for entries in journal.pending(JOURNAL_DRAIN_BATCH):
+            by_channel = {}
+            for entry in entries:
+                if owns_chat(entry["chat_id"]): by_channel.setdefault(entry["chat_id"], []).append(entry)
+            for channel_id, channel_entries in by_channel.items():
+                ids = [entry["message_id"] for entry in channel_entries]
+                # One channel's bad entries must not keep the others from being resumed; they stay pending for the next start.
+                try: resumed += await resume_channel(bot, channel_id, channel_entries)
+                except Exception as e:
+                    logger.error(f"Failed to resume {len(ids)} journaled posts of {channel_id}: {e}"); journal.abandon(channel_id, ids); failed += len(ids)
+    except Exception as e: logger.error(f"Journal drain stopped: {e}")
+    if resumed or failed: logger.info(f"Resumed {resumed} journaled posts from the previous run, {failed} failed")
+
+async def resume_channel(bot, channel_id, entries):
+    entries = journal.claim(sorted(entries, key=lambda entry: entry["message_id"]))
+    if not entries: return 0
+    settings = await get_channel_settings(channel_id); ids = [entry["message_id"] for entry in entries]
+    if not settings:
+        journal.mark("captioned", channel_id, ids); journal.mark("mirrored", channel_id, ids); return 0
+    await process_entries(bot, settings, channel_id, entries); return len(entries)
+
+async def reapply_caption(bot, channel_id, limit):
+    """Re-renders the current caption onto the channel's last `limit` journaled posts and returns how many were edited.
+
+    Posts are read from the journal and edited one batch at a time at the lowest send priority, so live posts go first.
+    """
+    settings = await get_channel_settings(channel_id) or {}; edited = 0
+    async for entries in journal.recent(channel_id, limit, REAPPLY_BATCH_SIZE):
+        futures = []
+        for entry in entries:
+            new_caption = entry_caption(settings, channel_id, entry)
+            if new_caption is None: continue
+            futures.append(sender.submit(channel_id, partial(bot.edit_message_caption, chat_id=channel_id, message_id=entry["message_id"], caption=new_caption, parse_mode='HTML'), PRIORITY_REAPPLY, f"caption re-apply in {channel_id}"))
+        # "Message is not modified" resolves to None: the post already had this caption.
+        edited += sum(result is not None and not isinstance(result, Exception) for result in await asyncio.gather(*futures, return_exceptions=True))
+    return edited
+
+async def process_album(messages):
+    started = time.perf_counter()
+    with stage_seconds.time(stage="settings"): settings = await get_channel_settings(messages[0].chat.id)
+    if settings: await process_posts(messages[0].get_bot(), settings, messages, started)
+
+album_collector = MediaGroupCollector(process_album, window=ALBUM_WINDOW, max_wait=ALBUM_MAX_WAIT)
+GaugeFunction("autocaption_album_pending_posts", "Album posts waiting for their media group to complete.", album_collector.pending)
+
 async def auto_caption_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.channel_post: return
-    message = update.channel_post; channel_id = message.chat.id; message_id = message.message_id
-    settings = get_channel_settings(channel_id)
+    message = update.channel_post
+    if message.media_group_id: return album_collector.add(message)
+    started = time.perf_counter()
+    with stage_seconds.time(stage="settings"): settings = await get_channel_settings(message.chat.id)
     if not settings: return
-    try:
-        if message.document: await context.bot.send_document(chat_id=LOG_CHANNEL_ID, document=message.document.file_id, caption=message.caption)
-        elif message.video: await context.bot.send_video(chat_id=LOG_CHANNEL_ID, video=message.video.file_id, caption=message.caption)
-        elif message.photo: await context.bot.send_photo(chat_id=LOG_CHANNEL_ID, photo=message.photo[-1].file_id, caption=message.caption)
-        elif message.audio: await context.bot.send_audio(chat_id=LOG_CHANNEL_ID, audio=message.audio.file_id, caption=message.caption)
-    except Exception as e: logger.error(f"Failed to re-upload message to log channel: {e}")
-    file_caption = message.caption or ""; file_obj = message.document or message.video or message.audio or (message.photo[-1] if message.photo else None)
-    if not file_obj: return
-    original_file_name = getattr(file_obj, 'file_name', 'Photo')
-    cleaned_file_name = original_file_name
-    if settings.get("link_remover_on"):
-        cleaned_file_name = re.sub(r'https?://\S+|@\w+|\[.*?\]|\(.*?\)', '', cleaned_file_name)
-        cleaned_file_name = re.sub(r'[_.-]{2,}', '_', cleaned_file_name).strip('_. -')
-    banned_words = settings.get("banned_words", [])
-    if banned_words:
-        pattern = r'\b(' + '|'.join(re.escape(word) for word in banned_words) + r')\b'
-        cleaned_file_name = re.sub(pattern, '', cleaned_file_name, flags=re.IGNORECASE).strip()
-        cleaned_file_name = re.sub(r'\s{2,}', ' ', cleaned_file_name).strip()
-        cleaned_file_name = re.sub(r'[_.-]{2,}', '_', cleaned_file_name).strip('_. -')
-    file_title, file_ext = os.path.splitext(cleaned_file_name)
-    new_caption_template = settings.get("caption_text") or ""
-    if new_caption_template:
-        file_size_mb = f"{file_obj.file_size / (1024*1024):.2f} MB" if file_obj.file_size else "N/A"
-        safe_full_name = html.escape(str(cleaned_file_name)); safe_title = html.escape(file_title); safe_file_caption = html.escape(file_caption)
-        new_caption = new_caption_template.replace("{file_name}", safe_full_name).replace("{file_title}", safe_title).replace("{file_size}", file_size_mb).replace("{file_caption}", safe_file_caption)
-    else: new_caption = cleaned_file_name
-    try:
-        if new_caption != (message.caption or ""): await context.bot.edit_message_caption(chat_id=channel_id, message_id=message_id, caption=new_caption, parse_mode='HTML')
-    except Exception as e:
-        if not ('message is not modified' in str(e).lower()): logger.error(f"Failed to edit caption in {channel_id}: {e}")
+    await process_posts(context.bot, settings, [message], started)
 
 async def handle_new_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.my_chat_member: return
@@ -285,12 +468,18 @@ async def handle_new_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if new_member.status == 'administrator':
         user_id = update.my_chat_member.from_user.id; chat_id = update.my_chat_member.chat.id
         logger.info(f"Bot promoted to admin in {chat_id} by user {user_id}")
-        channels_collection.update_one({"_id": chat_id}, {"$set": {"admin_user_id": user_id}}, upsert=True)
+        await update_channel_settings(chat_id, {"$set": {"admin_user_id": user_id, "chat_meta": make_chat_meta(update.my_chat_member.chat.title)}}, upsert=True)
         await context.bot.send_message(chat_id=user_id, text=f"✅ I've been successfully added as an admin to <b>{update.my_chat_member.chat.title}</b>!", parse_mode='HTML')
+    elif new_member.status in ('left', 'kicked'):
+        await update_channel_settings(update.my_chat_member.chat.id, {"$set": {"chat_meta": make_chat_meta(update.my_chat_member.chat.title, accessible=False)}})
 
-def main():
-    """Sets up and runs the bot."""
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(token=BOT_TOKEN, base_url=None, persistence=None, updater=True):
+    """Creates the Application and registers every handler. `base_url` points the bot at another Bot API server."""
+    builder = Application.builder().token(token).request(InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE))
+    if base_url: builder = builder.base_url(base_url)
+    if persistence: builder = builder.persistence(persistence)
+    if not updater: builder = builder.updater(None)
+    application = builder.build()
     application.add_error_handler(error_handler)
     
     conv_handler = ConversationHandler(
@@ -298,15 +487,19 @@ def main():
         states={
             SELECT_CHANNEL: [CallbackQueryHandler(main_menu, pattern=r'^channel_')],
             MAIN_MENU: [
-                CallbackQueryHandler(caption_menu, pattern='^manage_caption$'),
-                CallbackQueryHandler(words_remover_menu, pattern='^manage_words_remover$'),
+                CallbackQueryHandler(caption_menu, pattern='^caption_menu$'),
+                CallbackQueryHandler(words_remover_menu, pattern='^words_remover_menu$'),
                 CallbackQueryHandler(toggle_link_remover, pattern='^toggle_link_remover$'),
+                CallbackQueryHandler(toggle_album_first_only, pattern='^toggle_album_first_only$'),
                 CallbackQueryHandler(confirm_remove_channel, pattern='^confirm_remove$'),
                 CallbackQueryHandler(settings_start, pattern='^settings_menu$'),
             ],
             CAPTION_MENU: [
                 CallbackQueryHandler(set_caption_prompt, pattern='^set_caption_prompt$'),
                 CallbackQueryHandler(delete_caption, pattern='^delete_caption$'),
+                CallbackQueryHandler(reapply_prompt, pattern='^reapply_prompt$'),
+                CallbackQueryHandler(start_reapply, pattern=r'^reapply_\d+$'),
+                CallbackQueryHandler(caption_menu, pattern='^caption_menu$'),
                 CallbackQueryHandler(main_menu, pattern='^main_menu_back$'),
             ],
             WORDS_REMOVER_MENU: [
@@ -314,12 +507,12 @@ def main():
                 CallbackQueryHandler(delete_words_remover, pattern='^delete_words_remover$'),
                 CallbackQueryHandler(main_menu, pattern='^main_menu_back$'),
             ],
-            AWAITING_CAPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_caption)],
-            AWAITING_WORDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_words_remover)],
+            AWAITING_CAPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_caption), CallbackQueryHandler(caption_menu, pattern='^caption_menu$')],
+            AWAITING_WORDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_words_remover), CallbackQueryHandler(words_remover_menu, pattern='^words_remover_menu$')],
             CONFIRM_REMOVE: [CallbackQueryHandler(perform_remove_channel, pattern='^delete_channel$'), CallbackQueryHandler(main_menu, pattern='^main_menu_back$')],
         },
         fallbacks=[CommandHandler('cancel', cancel), CallbackQueryHandler(cancel, pattern='^cancel$')],
-        per_message=False, allow_reentry=True
+        per_message=False, allow_reentry=True, name="settings", persistent=persistence is not None
     )
 
     application.add_handler(CommandHandler("start", start))
@@ -329,13 +522,80 @@ def main():
     file_filter = (filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO) & filters.ChatType.CHANNEL
     application.add_handler(MessageHandler(file_filter, auto_caption_handler))
     application.add_handler(ChatMemberHandler(handle_new_admin, ChatMemberHandler.MY_CHAT_MEMBER))
-    
-    logger.info("Starting bot polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return application
+
+# Only the update types the handlers above consume. Keep in sync when registering new handlers.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHANNEL_POST, Update.MY_CHAT_MEMBER]
+
+def stop_on_signals():
+    stop_event = asyncio.Event(); loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def receive_updates(bot, updater, stop_event):
+    """Registers the webhook, or long-polls with `updater`, until `stop_event` is set."""
+    if WEBHOOK_URL:
+        logger.info("Starting bot in webhook mode...")
+        if not WEBHOOK_SECRET: logger.warning("WEBHOOK_INSECURE is set: accepting webhook updates without a secret token")
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, allowed_updates=ALLOWED_UPDATES, max_connections=WEBHOOK_MAX_CONNECTIONS, secret_token=WEBHOOK_SECRET)
+    else:
+        logger.info("Starting bot polling...")
+        await updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+    try: await stop_event.wait()
+    finally:
+        if updater.running: await updater.stop()
+
+async def serve(application):
+    """Runs the bot and the HTTP server (health check plus webhook) on one event loop until SIGINT/SIGTERM."""
+    stop_event = stop_on_signals()
+    http_server = make_web_app(application_receiver(application), WEBHOOK_PATH if WEBHOOK_URL else None, WEBHOOK_SECRET, PROFILER_ENABLED).listen(PORT)
+    try:
+        async with application:
+            await on_startup(application); await application.start()
+            try: await receive_updates(application.bot, application.updater, stop_event)
+            finally:
+                await application.stop(); await on_shutdown(application)
+                http_server.stop()
+    # Application.shutdown() still flushes persistence, so the database goes last.
+    finally: close_db()
+
+async def serve_receiver(router):
+    """Receives updates like `serve` but hands them to the shard workers instead of processing them."""
+    GaugeFunction("autocaption_shard_workers_alive", "Shard worker processes currently running.", router.alive)
+    GaugeFunction("autocaption_shard_worker_restarts", "Restarts of each shard worker after it exited.", lambda: dict(enumerate(router.restarts)), ["worker"])
+    stop_event = stop_on_signals()
+    worker_ports = [SHARD_METRICS_PORT + index for index in range(router.count)]
+    http_server = make_web_app(router.dispatch, WEBHOOK_PATH if WEBHOOK_URL else None, WEBHOOK_SECRET, PROFILER_ENABLED, shard_metrics(worker_ports)).listen(PORT)
+    updates = asyncio.Queue(); updater = Updater(Bot(BOT_TOKEN), updates)
+    async def forward():
+        while True: await router.dispatch((await updates.get()).to_dict())
+    forwarder = asyncio.create_task(forward())
+    async with updater:
+        try: await receive_updates(updater.bot, updater, stop_event)
+        finally: forwarder.cancel(); http_server.stop()
+
+async def run_worker(index, count, inbox, control):
+    """Entry point of one shard worker process. Settings and conversation state are shared through Mongo."""
+    settings_listeners.append(lambda channel_id: control.put((index, {"invalidate_settings": channel_id})))
+    application = build_application(persistence=MongoPersistence(update_interval=PERSISTENCE_INTERVAL), updater=False)
+    application.bot_data["shard"] = (index, count, control)
+    http_server = make_web_app(None, enable_profiler=PROFILER_ENABLED).listen(SHARD_METRICS_PORT + index, address="127.0.0.1")
+    try:
+        async with application:
+            await on_startup(application, shard=(index, count)); await application.start()
+            logger.info(f"Shard worker {index + 1}/{count} ready")
+            on_control = {"invalidate_settings": settings_cache.invalidate, "reapply": lambda job: application.create_task(run_reapply(application.bot, **job))}
+            try: await consume(inbox, application_receiver(application), on_control)
+            finally: await application.stop(); await on_shutdown(application)
+    finally: http_server.stop(); close_db()
+
+def main():
+    """Sets up and runs the bot."""
+    if SHARD_WORKERS > 1:
+        router = ShardRouter(SHARD_WORKERS, run_worker); router.start()
+        try: asyncio.run(serve_receiver(router))
+        finally: router.stop()
+    else: asyncio.run(serve(build_application()))
 
 if __name__ == "__main__":
-    # Start the web server to keep the bot alive
-    keep_alive()
-    
-    # This is the main, blocking call that runs the bot.
     main()
\ No newline at end of file
@@ -0,0 +1,150 @@
+# metrics.py - in-process counters and histograms rendered in the Prometheus text format
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter as TallyCounter
+from contextlib import contextmanager
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value): return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name; self.documentation = documentation; self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels): return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs); self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock: items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs); self.buckets = tuple(buckets); self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None: counts = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound: counts[0][index] += 1; break
+            counts[1] += 1; counts[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock: items = [(key, list(counts[0]), counts[1], counts[2]) for key, counts in self._values.items()]
+        lines = []
+        for key, bucket_counts, count, total in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count; lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+        return lines
+
+class GaugeFunction(Metric):
+    """A gauge read at scrape time. `function` returns a number, or a dict of label value to number for one label."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames); self.function = function
+
+    def _samples(self):
+        value = self.function()
+        if not isinstance(value, dict): return [f"{self.name} {value}"]
+        return [f"{self.name}{_format_labels(self.labelnames, (label,))} {item}" for label, item in value.items()]
+
+REGISTRY = []
+
+def render_metrics():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+def merge_metrics(sources, label):
+    """Merges `(label_value, text)` pairs of rendered metrics into one text, adding `label` to every sample."""
+    families = {}
+    for label_value, text in sources:
+        family = None; pair = f'{label}="{_escape(label_value)}"'
+        for line in text.splitlines():
+            if line.startswith("# "):
+                name = line.split(" ", 3)[2]; family = families.setdefault(name, ([], []))
+                if line not in family[0]: family[0].append(line)
+            elif line and family is not None:
+                sample, value = line.rsplit(" ", 1)
+                sample = sample.replace("{", "{" + pair + ",", 1) if "{" in sample else f"{sample}{{{pair}}}"
+                family[1].append(f"{sample} {value}")
+    return "\n".join(line for headers, samples in families.values() for line in headers + samples) + "\n"
+
+# --- Hot Path Metrics ---
+update_seconds = Histogram("autocaption_update_seconds", "End-to-end latency of a channel post, from handler start until its caption is edited or needs no edit.")
+stage_seconds = Histogram("autocaption_stage_seconds", "Latency of each auto caption stage.", ["stage"])
+mongo_seconds = Histogram("autocaption_mongo_call_seconds", "Latency of MongoDB calls.", ["operation"])
+bot_api_seconds = Histogram("autocaption_bot_api_call_seconds", "Latency of Bot API calls.", ["method"])
+bot_api_errors = Counter("autocaption_bot_api_errors_total", "Bot API errors by kind.", ["kind"])
+channel_posts = Counter("autocaption_channel_posts_total", "Channel posts handled, by channel.", ["channel"])
+
+def record_error(error):
+    if isinstance(error, RetryAfter): kind = "retry_after"
+    elif isinstance(error, BadRequest) and 'message is not modified' in str(error).lower(): kind = "not_modified"
+    elif isinstance(error, Forbidden): kind = "forbidden"
+    else: kind = "other"
+    bot_api_errors.inc(kind=kind)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the latency of every Bot API call by method name."""
+
+    async def do_request(self, url, *args, **kwargs):
+        with bot_api_seconds.time(method=url.rsplit('/', 1)[-1]): return await super().do_request(url, *args, **kwargs)
+
+# --- Sampling Profiler ---
+class SamplingProfiler:
+    """Samples one thread's Python stack every `interval` seconds and counts collapsed stacks (flamegraph input)."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id; self.interval = interval; self.samples = TallyCounter(); self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id); stack = []
+            while frame is not None: stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_firstlineno})"); frame = frame.f_back
+            if stack: self.samples[";".join(reversed(stack))] += 1
+
+    async def profile(self, seconds):
+        thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True); thread.start()
+        try: await asyncio.sleep(seconds)
+        finally: self._stop.set(); thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
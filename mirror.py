@@ -0,0 +1,100 @@
+# mirror.py - background pipeline that copies channel posts to the log channel in batches
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import partial
+
+from telegram.error import BadRequest, Forbidden
+
+from metrics import stage_seconds
+from sender import PRIORITY_MIRROR
+
+logger = logging.getLogger(__name__)
+
+class MirrorPipeline:
+    """Buffers posts per source channel and copies them to the log channel with copy_messages.
+
+    A batch is flushed when it reaches `batch_size` ids or `linger` seconds after its first post. Batches of one
+    source channel are sent one after another, so the log keeps each channel's order, and failed batches are
+    retried with capped backoff until they succeed or Telegram rejects them outright. Either way `on_settled` is then
+    called with the source chat id and the batch's message ids. At most `maxsize` ids are queued, buffered or waiting
+    in batches at once; `enqueue` waits for room beyond that.
+    """
+
+    def __init__(self, sender, log_chat_id, maxsize=10000, batch_size=100, linger=2.0, max_backoff=300, on_settled=None):
+        self.sender = sender; self.log_chat_id = log_chat_id; self.maxsize = maxsize; self.batch_size = batch_size; self.linger = linger; self.max_backoff = max_backoff; self.on_settled = on_settled
+        self._queue = asyncio.Queue(); self._outstanding = 0; self._room = asyncio.Event(); self._buffers = {}; self._deadlines = {}; self._batches = {}; self._workers = {}
+        self._bot = None; self._collector = None
+        self.copied = 0; self.batches = 0; self.dropped = 0
+
+    # --- Public API ---
+    async def enqueue(self, chat_id, message_ids):
+        """Queues posts for mirroring. Waits while `maxsize` ids are unsettled so bursts apply backpressure instead of growing memory."""
+        # A post larger than the whole limit is still let through once nothing else is outstanding.
+        while self._outstanding and self._outstanding + len(message_ids) > self.maxsize: self._room.clear(); await self._room.wait()
+        self._outstanding += len(message_ids); self._queue.put_nowait((chat_id, message_ids))
+
+    def start(self, bot):
+        self._bot = bot
+        if self._collector is None: self._collector = asyncio.create_task(self._collect(), name="log-mirror")
+
+    async def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        if self._collector: self._collector.cancel(); self._collector = None
+        for chat_id in list(self._buffers): self._flush(chat_id)
+        workers = list(self._workers.values())
+        if workers: await asyncio.wait(workers, timeout=max(deadline - time.monotonic(), 0.1))
+        for worker in workers: worker.cancel()
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "outstanding": self._outstanding, "buffered": sum(len(ids) for ids in self._buffers.values()),
+                "pending_batches": sum(len(batches) for batches in self._batches.values()), "copied": self.copied, "batches": self.batches, "dropped": self.dropped}
+
+    # --- Batching ---
+    def _settle(self, count):
+        self._outstanding -= count; self._room.set()
+
+    async def _collect(self):
+        while True:
+            timeout = max(min(self._deadlines.values()) - time.monotonic(), 0) if self._deadlines else None
+            try:
+                chat_id, message_ids = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                buffer = self._buffers.setdefault(chat_id, [])
+                if not buffer: self._deadlines[chat_id] = time.monotonic() + self.linger
+                buffer.extend(message_ids)
+                if len(buffer) >= self.batch_size: self._flush(chat_id)
+            except asyncio.TimeoutError: pass
+            now = time.monotonic()
+            for chat_id in [chat_id for chat_id, due in self._deadlines.items() if due <= now]: self._flush(chat_id)
+
+    def _flush(self, chat_id):
+        buffered = self._buffers.pop(chat_id, ()); message_ids = sorted(set(buffered)); self._deadlines.pop(chat_id, None)
+        if len(buffered) > len(message_ids): self._settle(len(buffered) - len(message_ids))
+        batches = self._batches.setdefault(chat_id, deque())
+        for start in range(0, len(message_ids), self.batch_size): batches.append(message_ids[start:start + self.batch_size])
+        if batches and chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._send_batches(chat_id))
+
+    async def _send_batches(self, chat_id):
+        batches = self._batches[chat_id]
+        try:
+            while batches:
+                batch = batches[0]; attempt = 0
+                while True:
+                    try:
+                        submitted = time.perf_counter()
+                        await self.sender.submit(self.log_chat_id, partial(self._bot.copy_messages, chat_id=self.log_chat_id, from_chat_id=chat_id, message_ids=batch),
+                                                 PRIORITY_MIRROR, f"log mirror of {len(batch)} posts from {chat_id}")
+                        stage_seconds.observe(time.perf_counter() - submitted, stage="mirror_send")
+                        self.copied += len(batch); self.batches += 1; break
+                    except (Forbidden, BadRequest) as e:
+                        logger.error(f"Dropping log mirror of {len(batch)} posts from {chat_id}: {e}"); self.dropped += len(batch); break
+                    except Exception:
+                        attempt += 1; await asyncio.sleep(min(2 ** attempt, self.max_backoff))
+                batches.popleft(); self._settle(len(batch))
+                if self.on_settled: self.on_settled(chat_id, batch)
+        finally:
+            del self._workers[chat_id]
+            if not batches: self._batches.pop(chat_id, None)
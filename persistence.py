@@ -0,0 +1,78 @@
+# persistence.py - Mongo-backed persistence for conversation state and user_data
+import asyncio
+import logging
+
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import bot_state_collection, run
+
+logger = logging.getLogger(__name__)
+
+def load_state(kind, name=None):
+    filter = {"kind": kind} if name is None else {"kind": kind, "name": name}
+    return list(bot_state_collection.find(filter))
+
+def write_state(operations):
+    return bot_state_collection.bulk_write(operations, ordered=False)
+
+class MongoPersistence(BasePersistence):
+    """Keeps user_data and ConversationHandler states in the bot_state collection.
+
+    Writes are buffered and sent as one bulk_write `flush_delay` seconds after the first change, so the burst of
+    updates PTB issues every `update_interval` costs a single round trip. Chat and bot data are not used by the bot.
+    """
+
+    def __init__(self, update_interval=5, flush_delay=0.05):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self.flush_delay = flush_delay; self._pending = {}; self._flush_task = None
+
+    # --- Loading ---
+    async def get_user_data(self):
+        return {doc["user_id"]: doc["data"] for doc in await run(load_state, "user_data")}
+
+    async def get_conversations(self, name):
+        return {tuple(doc["key"]): doc["state"] for doc in await run(load_state, "conversation", name)}
+
+    async def get_chat_data(self): return {}
+    async def get_bot_data(self): return {}
+    async def get_callback_data(self): return None
+
+    # --- Buffered Writes ---
+    def _schedule(self, key, operation):
+        self._pending[key] = operation
+        if self._flush_task is None or self._flush_task.done(): self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay); await self._write()
+
+    async def _write(self):
+        operations = list(self._pending.values()); self._pending.clear()
+        if not operations: return
+        try: await run(write_state, operations)
+        except Exception as e: logger.error(f"Failed to persist {len(operations)} bot state changes: {e}")
+
+    async def update_user_data(self, user_id, data):
+        key = f"user_data:{user_id}"
+        self._schedule(key, UpdateOne({"_id": key}, {"$set": {"kind": "user_data", "user_id": user_id, "data": dict(data)}}, upsert=True))
+
+    async def drop_user_data(self, user_id):
+        key = f"user_data:{user_id}"; self._schedule(key, DeleteOne({"_id": key}))
+
+    async def update_conversation(self, name, key, new_state):
+        doc_id = f"conversation:{name}:{':'.join(map(str, key))}"
+        if new_state is None: self._schedule(doc_id, DeleteOne({"_id": doc_id}))
+        else: self._schedule(doc_id, UpdateOne({"_id": doc_id}, {"$set": {"kind": "conversation", "name": name, "key": list(key), "state": new_state}}, upsert=True))
+
+    async def flush(self):
+        if self._flush_task and not self._flush_task.done(): await self._flush_task
+        await self._write()
+
+    # Updates for one user are always routed to the same worker, so its in-memory copy is already current.
+    async def refresh_user_data(self, user_id, user_data): pass
+    async def refresh_chat_data(self, chat_id, chat_data): pass
+    async def refresh_bot_data(self, bot_data): pass
+    async def update_chat_data(self, chat_id, data): pass
+    async def update_bot_data(self, data): pass
+    async def update_callback_data(self, data): pass
+    async def drop_chat_data(self, chat_id): pass
@@ -0,0 +1,141 @@
+# sender.py - flood-limit-aware scheduler for outbound Bot API calls
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+from metrics import record_error
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CAPTION, PRIORITY_MIRROR, PRIORITY_REAPPLY = 0, 1, 2
+
+def _seconds(value): return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`. `blocked_until` holds a RetryAfter pause."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate; self.capacity = capacity; self.tokens = capacity
+        self.updated = time.monotonic(); self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        if now < self.blocked_until: return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self): self.tokens -= 1
+    def block(self, until): self.blocked_until = max(self.blocked_until, until)
+
+class _Job:
+    __slots__ = ("chat_id", "priority", "call", "future", "description", "enqueued", "attempts")
+
+    def __init__(self, chat_id, priority, call, description):
+        self.chat_id = chat_id; self.priority = priority; self.call = call; self.description = description
+        self.future = asyncio.get_running_loop().create_future(); self.enqueued = time.monotonic(); self.attempts = 0
+
+class SendScheduler:
+    """Runs Bot API calls under a global and a per-chat token bucket.
+
+    Calls for one chat run one at a time and in submission order. Lower priority values are dispatched first.
+    RetryAfter pauses the chat and requeues the call at the head of its queue; timeouts are retried with backoff.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=20 / 60, chat_burst=3, max_in_flight=16, max_attempts=5, chat_rates=None):
+        self.chat_rate = chat_rate; self.chat_rates = chat_rates or {}; self.chat_burst = chat_burst; self.max_in_flight = max_in_flight; self.max_attempts = max_attempts
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}; self._queues = {}; self._busy = set(); self._tasks = set()
+        self._wakeup = asyncio.Event(); self._dispatcher = None
+        self.sent = 0; self.retried = 0; self.failed = 0; self.wait_total = 0.0; self.wait_max = 0.0
+
+    # --- Public API ---
+    def submit(self, chat_id, call, priority=PRIORITY_CAPTION, description="request"):
+        """Queues `call` (a zero-argument coroutine function) and returns a future for its result."""
+        job = _Job(chat_id, priority, call, description)
+        job.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._queues.setdefault(priority, OrderedDict()).setdefault(chat_id, deque()).append(job)
+        self._wakeup.set(); return job.future
+
+    def start(self):
+        if self._dispatcher is None: self._dispatcher = asyncio.create_task(self._dispatch_loop(), name="send-scheduler")
+
+    async def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while (self.queued() or self._tasks) and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        if self._dispatcher: self._dispatcher.cancel()
+        for task in list(self._tasks): task.cancel()
+        self._dispatcher = None
+
+    def queued(self, priority=None):
+        queues = [self._queues.get(priority, {})] if priority is not None else self._queues.values()
+        return sum(len(jobs) for chats in queues for jobs in chats.values())
+
+    def stats(self):
+        return {
+            "queued": {priority: self.queued(priority) for priority in sorted(self._queues)}, "in_flight": len(self._tasks),
+            "sent": self.sent, "retried": self.retried, "failed": self.failed,
+            "wait_avg": self.wait_total / self.sent if self.sent else 0.0, "wait_max": self.wait_max,
+        }
+
+    # --- Dispatching ---
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None: bucket = self._buckets[chat_id] = TokenBucket(self.chat_rates.get(chat_id, self.chat_rate), self.chat_burst)
+        return bucket
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch_ready()
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError: pass
+
+    def _dispatch_ready(self):
+        # Returns how long to sleep before the next job can become ready, or None to wait for a wakeup.
+        now = time.monotonic(); next_delay = None
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            for chat_id in list(chats):
+                if len(self._tasks) >= self.max_in_flight: return None
+                if chat_id in self._busy: continue
+                global_wait = self._global.wait_time(now)
+                if global_wait: return global_wait if next_delay is None else min(next_delay, global_wait)
+                bucket = self._bucket(chat_id); wait = bucket.wait_time(now)
+                if wait: next_delay = wait if next_delay is None else min(next_delay, wait); continue
+                jobs = chats[chat_id]; job = jobs.popleft()
+                if jobs: chats.move_to_end(chat_id)
+                else: del chats[chat_id]
+                bucket.consume(); self._global.consume(); self._busy.add(chat_id)
+                task = asyncio.create_task(self._run(job, now)); self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+        return next_delay
+
+    def _requeue(self, job):
+        self._queues.setdefault(job.priority, OrderedDict()).setdefault(job.chat_id, deque()).appendleft(job)
+
+    async def _run(self, job, started):
+        job.attempts += 1
+        try: result = await job.call()
+        except RetryAfter as e:
+            record_error(e); self.retried += 1; self._bucket(job.chat_id).block(time.monotonic() + _seconds(e.retry_after))
+            logger.warning(f"Flood limit on {job.description}, retrying in {_seconds(e.retry_after)}s"); self._requeue(job)
+        except BadRequest as e:
+            if 'message is not modified' in str(e).lower(): record_error(e); self._finish(job, started); job.future.set_result(None)
+            else: self._fail(job, e)
+        except (TimedOut, NetworkError) as e:
+            if job.attempts >= self.max_attempts: self._fail(job, e)
+            else:
+                self.retried += 1; self._bucket(job.chat_id).block(time.monotonic() + 2 ** job.attempts); self._requeue(job)
+        except Exception as e: self._fail(job, e)
+        else: self._finish(job, started); job.future.set_result(result)
+        finally: self._busy.discard(job.chat_id); self._wakeup.set()
+
+    def _finish(self, job, started):
+        waited = started - job.enqueued
+        self.sent += 1; self.wait_total += waited; self.wait_max = max(self.wait_max, waited)
+
+    def _fail(self, job, error):
+        self.failed += 1; record_error(error); logger.error(f"Failed {job.description}: {error}")
+        job.future.set_exception(error)
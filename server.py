@@ -0,0 +1,75 @@
+# server.py - one asyncio HTTP server for the health check and the Telegram webhook
+import asyncio
+import hmac
+import json
+import logging
+import threading
+
+import tornado.web
+from telegram import Update
+from tornado.httpclient import AsyncHTTPClient
+
+from metrics import SamplingProfiler, merge_metrics, render_metrics
+
+logger = logging.getLogger(__name__)
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("I'm alive!")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, render): self.render = render
+
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(await self.render())
+
+async def local_metrics(): return render_metrics()
+
+def shard_metrics(ports):
+    """Returns a metrics renderer that merges this process's metrics with those served by the shard workers on
+    local `ports`, labelled worker="receiver" and worker="<index>"."""
+    client = AsyncHTTPClient()
+    async def fetch(port):
+        try: return (await client.fetch(f"http://127.0.0.1:{port}/metrics", request_timeout=5)).body.decode()
+        except Exception as e: logger.warning(f"Failed to scrape shard metrics on port {port}: {e}"); return ""
+    async def render():
+        texts = await asyncio.gather(*(fetch(port) for port in ports))
+        return merge_metrics([("receiver", render_metrics()), *((str(index), text) for index, text in enumerate(texts))], "worker")
+    return render
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Samples the event loop thread for ?seconds=N (default 10, max 60) and returns collapsed stacks."""
+
+    async def get(self):
+        seconds = min(float(self.get_argument("seconds", 10)), 60)
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.write(await SamplingProfiler(threading.get_ident()).profile(seconds))
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Accepts Update JSON posted by Telegram with the matching secret token header (any post if `secret_token` is None).
+
+    `on_update` is awaited with the decoded JSON object.
+    """
+
+    def initialize(self, on_update, secret_token):
+        self.on_update = on_update; self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and not hmac.compare_digest(self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret_token): raise tornado.web.HTTPError(403)
+        try: await self.on_update(json.loads(self.request.body))
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}"); raise tornado.web.HTTPError(400)
+
+    def check_xsrf_cookie(self): pass
+
+def application_receiver(application):
+    """Returns an `on_update` callback that queues updates on a python-telegram-bot Application."""
+    async def on_update(data): await application.update_queue.put(Update.de_json(data, application.bot))
+    return on_update
+
+def make_web_app(on_update, webhook_path=None, secret_token=None, enable_profiler=False, metrics=local_metrics):
+    handlers = [(r"/", HealthHandler), (r"/metrics", MetricsHandler, {"render": metrics})]
+    if enable_profiler: handlers.append((r"/debug/profile", ProfileHandler))
+    if webhook_path: handlers.append((webhook_path, WebhookHandler, {"on_update": on_update, "secret_token": secret_token}))
+    return tornado.web.Application(handlers)
@@ -0,0 +1,162 @@
+# shards.py - routes updates to worker processes partitioned by chat id
+import asyncio
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Fields that carry a chat, in the order they are checked. A user's private chat id equals their user id, so every
+# update of one settings conversation (messages and button presses alike) lands on the same worker.
+CHAT_FIELDS = ("channel_post", "edited_channel_post", "message", "edited_message", "my_chat_member", "chat_member")
+
+def shard_key(data):
+    for field in CHAT_FIELDS:
+        if field in data: return data[field]["chat"]["id"]
+    if "callback_query" in data:
+        query = data["callback_query"]
+        return query["message"]["chat"]["id"] if query.get("message") else query["from"]["id"]
+    return 0
+
+def shard_of_chat(chat_id, count):
+    return zlib.crc32(str(chat_id).encode()) % count
+
+def shard_for(data, count):
+    return shard_of_chat(shard_key(data), count)
+
+class ShardRouter:
+    """Starts `count` worker processes and hands each raw update to the worker that owns its chat.
+
+    Each worker runs `worker_main(index, count, inbox, control)` in its own event loop and processes its inbox in
+    order, which keeps posts of one channel in order. Workers put `(index, message)` on `control` to reach the others:
+    a message with a `chat_id` goes to the worker that owns that chat, any other message (e.g. a settings invalidation)
+    to every worker but the sender.
+
+    Each inbox is a one-way pipe fed from a router-side buffer by its own thread, so `dispatch` never blocks on a
+    slow worker. A worker that exits is restarted with capped exponential backoff; the backoff resets once a worker
+    has stayed up for `stable_after` seconds. Updates still waiting in its pipe are handed to the replacement ahead
+    of newer ones.
+    """
+
+    def __init__(self, count, worker_main, check_interval=1.0, max_backoff=60, stable_after=300):
+        self._context = multiprocessing.get_context("spawn"); self._worker_main = worker_main
+        self.count = count; self.control = self._context.Queue()
+        self.check_interval = check_interval; self.max_backoff = max_backoff; self.stable_after = stable_after
+        self._lock = threading.Lock(); self._stopping = threading.Event()
+        self.inboxes = [self._context.Pipe(duplex=False) for _ in range(count)]
+        self._buffers = [deque() for _ in range(count)]; self._ready = [threading.Condition(self._lock) for _ in range(count)]
+        self._paused = [False] * count; self._sending = [False] * count
+        self.processes = [self._spawn(index, reader) for index, (reader, _) in enumerate(self.inboxes)]
+        self.restarts = [0] * count; self._failures = [0] * count; self._started_at = [0.0] * count; self._restart_at = {}
+
+    def start(self):
+        for index, process in enumerate(self.processes):
+            process.start(); self._started_at[index] = time.monotonic()
+            threading.Thread(target=self._feed, args=(index,), name=f"shard-feed-{index}", daemon=True).start()
+        self._router = threading.Thread(target=self._route_control, name="shard-control", daemon=True); self._router.start()
+        threading.Thread(target=self._watch_workers, name="shard-watchdog", daemon=True).start()
+        logger.info(f"Started {self.count} shard workers")
+
+    async def dispatch(self, data):
+        with self._lock: self._put(shard_for(data, self.count), data)
+
+    def alive(self): return sum(process.is_alive() for process in self.processes)
+
+    def stop(self, timeout=15):
+        self._stopping.set()
+        with self._lock:
+            for index in range(self.count): self._put(index, None)
+        for process in self.processes: process.join(timeout)
+        self.control.put(None); self._router.join(timeout)
+
+    def _route_control(self):
+        while (item := self.control.get()) is not None:
+            origin, message = item
+            with self._lock:
+                if "chat_id" in message: self._put(shard_of_chat(message["chat_id"], self.count), message); continue
+                for index in range(self.count):
+                    if index != origin: self._put(index, message)
+
+    # --- Inboxes ---
+    def _put(self, index, item):
+        # Called with self._lock held.
+        self._buffers[index].append(item); self._ready[index].notify()
+
+    def _feed(self, index):
+        while True:
+            with self._lock:
+                self._ready[index].wait_for(lambda: self._buffers[index] and not self._paused[index])
+                item = self._buffers[index].popleft(); writer = self.inboxes[index][1]; self._sending[index] = True
+            # Blocks while the worker's pipe is full, without holding up dispatch or the other workers.
+            try: writer.send(item)
+            except OSError as e: logger.error(f"Lost an update for shard worker {index}: {e}")
+            finally:
+                with self._lock: self._sending[index] = False; self._ready[index].notify_all()
+            if item is None: return
+
+    # --- Supervision ---
+    def _spawn(self, index, reader):
+        return self._context.Process(target=_run_worker, args=(self._worker_main, index, self.count, reader, self.control), name=f"shard-{index}", daemon=True)
+
+    def _watch_workers(self):
+        while not self._stopping.wait(self.check_interval):
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if process.is_alive() or self._stopping.is_set(): continue
+                if index not in self._restart_at:
+                    if now - self._started_at[index] >= self.stable_after: self._failures[index] = 0
+                    delay = min(2 ** self._failures[index], self.max_backoff); self._failures[index] += 1
+                    logger.error(f"Shard worker {index} exited with code {process.exitcode}, restarting in {delay}s")
+                    self._restart_at[index] = now + delay
+                elif now >= self._restart_at[index]:
+                    del self._restart_at[index]
+                    try: self._restart(index)
+                    except Exception as e: logger.error(f"Failed to restart shard worker {index}: {e}"); self._started_at[index] = now
+
+    def _restart(self, index):
+        # Dispatch keeps buffering while the feeder is paused and the old pipe is drained and a new worker spawned;
+        # only the final swap takes the lock. If the spawn fails, the old pipe is kept and refilled.
+        with self._lock: self._paused[index] = True
+        old = self.inboxes[index]; inbox = self._context.Pipe(duplex=False); moved = []; process = None
+        try:
+            moved = self._drain(index, old[0])
+            process = self._spawn(index, inbox[0]); process.start()
+        finally:
+            with self._lock:
+                started = process is not None and process.pid is not None
+                if started: self.inboxes[index] = inbox; self.processes[index] = process
+                self._buffers[index].extendleft(reversed(moved)); self._paused[index] = False; self._ready[index].notify()
+            for connection in (old if started else inbox): connection.close()
+        self._started_at[index] = time.monotonic(); self.restarts[index] += 1
+        logger.info(f"Restarted shard worker {index}, handing over {len(moved)} queued updates")
+
+    def _drain(self, index, reader):
+        """Reads back what a dead worker left in its pipe, including an update the feeder is still sending."""
+        moved = []
+        try:
+            while True:
+                while reader.poll(): moved.append(reader.recv())
+                with self._lock:
+                    if not self._sending[index] and not reader.poll(): return moved
+                    self._ready[index].wait(0.1)
+        except Exception as e:
+            logger.error(f"Dropping the rest of shard worker {index}'s inbox, which it left unreadable: {e}"); return moved
+
+def _run_worker(worker_main, index, count, inbox, control):
+    # Shutdown is driven by the router's stop marker, so a Ctrl+C or SIGTERM sent to the whole process group
+    # must not kill workers in the middle of a burst.
+    signal.signal(signal.SIGINT, signal.SIG_IGN); signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, count, inbox, control))
+
+async def consume(inbox, on_update, on_control):
+    """Feeds a worker's inbox into `on_update` until the router sends the stop marker. Control messages are recognised
+    by a key of `on_control`, whose handler gets the value under that key."""
+    loop = asyncio.get_running_loop()
+    while (data := await loop.run_in_executor(None, inbox.recv)) is not None:
+        key = next((key for key in on_control if key in data), None)
+        if key: on_control[key](data[key])
+        else: await on_update(data)